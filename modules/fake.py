@@ -4,22 +4,50 @@ from twisted.internet import defer
 import urlparse
 
 class FakeDownloader(object):
+	"""Downloads nothing. With "hold" in the config, downloads wait for
+	finish() or fail() instead of finishing right away."""
+
 	def __init__(self, manager, config):
 		self.manager = manager
+		self.hold = config.get('hold', False)
+		self.timeouts = config.get('timeouts', {})
+		self.requests = 0
+		self.held = []
 
 	def schemes(self):
 		return []
 
 	def download(self, f):
 		print('Fake Download: %s' % (f.url(),))
+		self.requests += 1
+		f._deferred = defer.Deferred()
+		if self.hold:
+			self.held.append(f)
+		else:
+			self.finish(f)
+		return f._deferred
+
+	def finish(self, f, data = ''):
+		if f in self.held:
+			self.held.remove(f)
 		f.open()
+		f.write(data)
 		f.close()
-		f._deferred = defer.Deferred()
 		f._deferred.callback(None)
-		return f._deferred
+
+	def fail(self, f, reason):
+		self.held.remove(f)
+		f._deferred.errback(reason)
+
+	def cancel(self, f):
+		if f not in self.held:
+			return False
+		# like a real teardown, the transfer fails with its own error
+		self.fail(f, ValueError('connection lost'))
+		return True
 
 
 module = {
 	"name" : "FakeDownloader",
 	"class" : FakeDownloader
-}
\ No newline at end of file
+}
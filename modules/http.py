@@ -1,28 +1,44 @@
 from twisted.web import client
-from twisted.internet import reactor, ssl
+from twisted.internet import reactor, ssl, defer
 
 import os
 import urlparse
 import urllib
 
 class HTTPDownloader(client.HTTPDownloader):
+	responseTimeout = None
+
 	def gotHeaders(self, headers):
+		self.stopResponseTimeout()
 		client.HTTPDownloader.gotHeaders(self, headers)
 		contentLength = headers.get("content-length", None)
-		if int(self.status) == 200 and contentLength:
+		if int(self.status) in (200, 206) and contentLength:
 			print("%s: Content-Length: %s" % (self.url, contentLength,))
-			self._file._size = int(contentLength[0])
+			self._file._size = int(contentLength[0]) + self.requestedPartial
 
 	def openFile(self, partialContent):
-		if partialContent:
-			raise ValueError('partial download not supported')
-		return self._file.open(self.fileName)
+		return self._file.open(self.fileName, append = partialContent)
+
+	def stopResponseTimeout(self):
+		if self.responseTimeout is not None and self.responseTimeout.active():
+			self.responseTimeout.cancel()
 
 class HttpDownloader(object):
+	"""Downloads http and https urls.
+
+	The "timeouts" config section, in seconds with 0 to disable, overrides
+	connect (TCP connection), response (until the response headers) and
+	progress (without data while downloading, see DownloaderFile.watch).
+	"""
+
 	ports = {'http' : 80, 'https' : 443}
+	timeouts = {'connect' : 30, 'response' : 60, 'progress' : 300}
 
 	def __init__(self, manager, config):
 		self.manager = manager
+		self.connectors = {}
+		self.timeouts = dict(self.timeouts)
+		self.timeouts.update(config.get('timeouts', {}))
 
 	def schemes(self):
 		return ['http', 'https']
@@ -34,8 +50,19 @@ class HttpDownloader(object):
 			raise ValueError('unknown scheme %s' % (parsed_url.scheme,))
 
 		#f.open()
-		name = urllib.unquote(os.path.basename(parsed_url.path)).decode('utf-8')
-		factory = HTTPDownloader(f.url(), name)
+		# unquote first, a quoted "/" must not survive basename()
+		name = os.path.basename(urllib.unquote(parsed_url.path)).decode('utf-8')
+		if os.sep in name or '..' in name:
+			raise ValueError('invalid file name %r' % (name,))
+		# resume what a previous attempt left behind
+		offset = 0
+		if f._received and not f._temp and os.path.exists(os.path.join(f._target, name)):
+			offset = os.path.getsize(os.path.join(f._target, name))
+		if offset:
+			factory = HTTPDownloader(f.url(), name, headers = {'range' : 'bytes=%d-' % (offset,)})
+			factory.requestedPartial = offset
+		else:
+			factory = HTTPDownloader(f.url(), name)
 		factory._file = f
 		if ':' in parsed_url.netloc:
 			host, port = parsed_url.netloc.split(':')
@@ -43,12 +70,35 @@ class HttpDownloader(object):
 		else:
 			host, port = parsed_url.netloc, self.ports[parsed_url.scheme]
 
+		# the file stays REQUESTED until the headers arrive, out of reach of
+		# the progress timeout
+		if self.timeouts['response']:
+			factory.responseTimeout = self.manager.clock.callLater(self.timeouts['response'], self.expire, f)
+
+		timeout = self.timeouts['connect']
 		if parsed_url.scheme == 'https':
-			reactor.connectSSL(host, port, factory, ssl.ClientContextFactory())
+			connector = reactor.connectSSL(host, port, factory, ssl.ClientContextFactory(), timeout = timeout)
 		else:
-			reactor.connectTCP(host, port, factory)
+			connector = reactor.connectTCP(host, port, factory, timeout = timeout)
+		self.connectors[id(f)] = connector
+		factory.deferred.addBoth(self.forget, f, factory)
 		return factory.deferred
 
+	def forget(self, result, f, factory):
+		factory.stopResponseTimeout()
+		del self.connectors[id(f)]
+		return result
+
+	def expire(self, f):
+		"""No response headers arrived in time."""
+		f.abort(defer.TimeoutError('no response from %s' % (f.url(),)))
+
+	def cancel(self, f):
+		if id(f) not in self.connectors:
+			return False
+		self.connectors[id(f)].disconnect()
+		return True
+
 module = {
     "name" : "HttpDownloader",
     "class" : HttpDownloader
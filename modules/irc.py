@@ -7,7 +7,6 @@ from twisted.python import log
 # system imports
 import time
 import sys
-import jinja2
 import json
 import urlparse
 import os
@@ -42,6 +41,7 @@ class XDccFileReceive(irc.DccFileReceiveBasic):
         self.overwrite = boolean
 
     def connectionMade(self):
+        self.factory.state = DccState.DOWNLOADING
         self.factory.file.open()
 
     def dataReceived(self, data):
@@ -58,16 +58,20 @@ class XDccFileReceive(irc.DccFileReceiveBasic):
             logmsg = ("%s  %d/%d bytes received"
                       % (logmsg, self.bytesReceived, self.factory.file._size))
             if self.bytesReceived == self.factory.file._size:
+                self.factory.finish(DccState.FINISHED)
                 self.factory.file._deferred.callback(None)
             elif self.bytesReceived < self.factory.file._size:
                 logmsg = ("%s (Warning: %d bytes short)"
                           % (logmsg, self.factory.file._size - self.bytesReceived))
+                self.factory.finish(DccState.ERROR)
                 self.factory.file._deferred.errback(ValueError("incomplete file"))
             else:
                 logmsg = ("%s (file larger than expected)"
                           % (logmsg,))
+                self.factory.finish(DccState.FINISHED)
                 self.factory.file._deferred.callback(None)
         else:
+            self.factory.finish(DccState.FINISHED)
             self.factory.file._deferred.callback(None)
             logmsg = ("%s  %d bytes received"
                       % (logmsg, self.bytesReceived))
@@ -92,14 +96,46 @@ class XDccFileReceiveFactory(protocol.ClientFactory):
     """A factory for XDccFileReceive.
 
     A new protocol instance will be created each time we connect to the server.
+    Once the transfer is over, I remove myself from the sessions list I was
+    registered in.
     """
 
     protocol = XDccFileReceive
 
-    def __init__(self, f, user):
+    def __init__(self, f, user, sessions, timeouts = {}, clock = reactor):
         self.file = f
         self.user = user
         self.state = DccState.WAITING
+        self.connector = None
+        self.sessions = sessions
+        self.timeouts = timeouts
+        self.offer_timeout = None
+        if timeouts.get('offer'):
+            self.offer_timeout = clock.callLater(timeouts['offer'], self.expire)
+
+    def connect(self, address, port):
+        """Called when the offer for this session arrived."""
+        if self.offer_timeout is not None and self.offer_timeout.active():
+            self.offer_timeout.cancel()
+        self.connector = reactor.connectTCP(address, port, self, timeout = self.timeouts.get('connect', 30))
+        self.state = DccState.CONNECTING
+
+    def finish(self, state):
+        self.state = state
+        if self.offer_timeout is not None and self.offer_timeout.active():
+            self.offer_timeout.cancel()
+        if self in self.sessions:
+            self.sessions.remove(self)
+
+    def expire(self):
+        """No offer arrived in time."""
+        if self.state == DccState.WAITING:
+            self.finish(DccState.ERROR)
+            self.file._deferred.errback(defer.TimeoutError("no DCC offer from %s" % (self.user,)))
+
+    def clientConnectionFailed(self, connector, reason):
+        self.finish(DccState.ERROR)
+        self.file._deferred.errback(reason)
 
 class IrcBot(irc.IRCClient):
     """An IRC bot."""
@@ -111,6 +147,7 @@ class IrcBot(irc.IRCClient):
 
     def signedOn(self):
         """Called when bot has succesfully signed on to server."""
+        self.factory.bot = self
         for channel in self.factory.channels:
             print('Joining channel #%s' % (channel,))
             self.join(channel)
@@ -149,17 +186,18 @@ class IrcBot(irc.IRCClient):
                     dcc.file._name = fileName
                     dcc.file._filename = fileName
                     dcc.file._size = size
-                    reactor.connectTCP(address, port, dcc)
-                    dcc.state = DccState.CONNECTING
+                    dcc.connect(address, port)
                     break
 
 class IrcBotFactory(protocol.ClientFactory):
     """A factory for IrcBots.
 
     A new protocol instance will be created each time we connect to the server.
+    Each factory is one identity on its network: DCC offers received by its
+    bot are only matched against the sessions it requested itself.
     """
 
-    dcc_sessions = {}
+    retry_delay = 30
 
     def __init__(self, host, port, nickname, channels):
         self.host = host
@@ -169,28 +207,80 @@ class IrcBotFactory(protocol.ClientFactory):
         self.channels = []
         for channel in channels:
             self.channels.append(channel.encode('ascii'))
+        # set once signed on, None while disconnected
         self.bot = None
+        self.dcc_sessions = {}
+
+    def load(self, nick = None):
+        """Number of unfinished DCC sessions, only those with nick if given."""
+        if nick:
+            sessions = self.dcc_sessions.get(nick, [])
+        else:
+            sessions = [dcc for dccs in self.dcc_sessions.values() for dcc in dccs]
+        return len([dcc for dcc in sessions if dcc.state not in (DccState.FINISHED, DccState.ERROR)])
 
     def buildProtocol(self, addr):
-        self.bot = IrcBot(self.nickname)
-        self.bot.factory = self
-        return self.bot
+        bot = IrcBot(self.nickname)
+        bot.factory = self
+        return bot
 
     def clientConnectionLost(self, connector, reason):
         """If we get disconnected, reconnect to server."""
+        self.bot = None
         connector.connect()
 
     def clientConnectionFailed(self, connector, reason):
         """If we can't connect, retry in a 30 secondes"""
         print "connection failed:", reason
+        self.bot = None
+        reactor.callLater(self.retry_delay, connector.connect)
         #reactor.stop()
 
+class IrcNetwork(object):
+    """A network reached through one or more identities.
+
+    XDCC bots usually allow one or two transfers per nickname, so packs are
+    spread over several connections, each with its own nickname.
+    """
+
+    def __init__(self, host, port, nicknames, channels):
+        self.host = host
+        self.port = port
+        self.channels = []
+        for channel in channels:
+            self.channels.append(channel.encode('ascii'))
+        self.identities = []
+        for nickname in nicknames:
+            identity = IrcBotFactory(host, port, nickname, channels)
+            self.identities.append(identity)
+            reactor.connectTCP(host, port, identity)
+
+    def select(self, nick):
+        """Pick the signed on identity with the fewest transfers from nick,
+        then the fewest transfers overall, None if none is signed on."""
+        identities = [identity for identity in self.identities if identity.bot]
+        if not identities:
+            return None
+        return min(identities, key = lambda identity: (identity.load(nick), identity.load()))
+
 class XdccDownloader(object):
+    """Downloads XDCC packs, irc://network/bot/xdcc send #n urls.
+
+    The "timeouts" config section, in seconds with 0 to disable, overrides
+    offer (until the bot sends its DCC offer, packs queued on a busy bot
+    wait for it too), connect (DCC connection) and progress (without data
+    while downloading, see DownloaderFile.watch).
+    """
+
     nickname = 'michelmichel'
+    timeouts = {'offer' : 600, 'connect' : 30, 'progress' : 300}
 
     isLeaf = True
 
     def __init__(self, manager, config):
+        self.manager = manager
+        self.timeouts = dict(self.timeouts)
+        self.timeouts.update(config.get('timeouts', {}))
         if 'nickname' in config:
             self.nickname = config['nickname'].encode('ascii')
         self.networks = {}
@@ -200,10 +290,25 @@ class XdccDownloader(object):
             else:
                 nickname = self.nickname
             
+            if 'nicknames' in config['networks'][network]:
+                nicknames = config['networks'][network]['nicknames']
+            else:
+                identities = config['networks'][network].get('identities', config.get('identities', 1))
+                nicknames = [nickname] + ['%s%d' % (nickname, i) for i in range(1, identities)]
+
             host = config['networks'][network]['server'][0]
             port = config['networks'][network]['server'][1]
-            self.networks[network.encode('ascii')] = IrcBotFactory(host, port, nickname, config['networks'][network]['channels'])
-            reactor.connectTCP(host, port, self.networks[network.encode('ascii')])
+            self.networks[network.encode('ascii')] = IrcNetwork(host, port, nicknames, config['networks'][network]['channels'])
+
+    @staticmethod
+    def partition(config):
+        """Split config into one config per network, so that each network
+        can run in its own worker process. Downloads are routed on either
+        the network name or its server host."""
+        for network in config['networks']:
+            part = dict(config)
+            part['networks'] = {network: config['networks'][network]}
+            yield [network, config['networks'][network]['server'][0]], part
 
     def render(self, path):
         if path == ['schemes']:
@@ -211,10 +316,10 @@ class XdccDownloader(object):
         html = '<h1>Networks</h1>\n'
         for network in self.networks:
             html += '<h2>' + network + '</h2>\n'
+            html += '<p>' + ', '.join(identity.nickname for identity in self.networks[network].identities) + '</p>\n'
             for channel in self.networks[network].channels:
                 html += '<h3>#' + channel + '</h3>\n'
-        template = jinja2.Template(open('modules/irc.html').read())
-        html += template.render(irc=self)
+        html += self.manager.render_template('modules/irc.html', irc=self)
         return html
 
     def schemes(self):
@@ -235,14 +340,36 @@ class XdccDownloader(object):
         if irc:
             nick, msg = os.path.split(parsed.path)
             nick = os.path.basename(nick)
-            irc.bot.msg(nick, msg)
-            if nick not in irc.dcc_sessions:
-                irc.dcc_sessions[nick] = []
-            irc.dcc_sessions[nick].append(XDccFileReceiveFactory(f, nick))
+            identity = irc.select(nick)
+            if identity is None:
+                f._deferred.errback(ValueError("not signed on to %s" % (parsed.netloc,)))
+                return f._deferred
+            identity.bot.msg(nick, msg)
+            if nick not in identity.dcc_sessions:
+                identity.dcc_sessions[nick] = []
+            sessions = identity.dcc_sessions[nick]
+            sessions.append(XDccFileReceiveFactory(f, nick, sessions, self.timeouts, self.manager.clock))
         else:
             f._deferred.errback(ValueError("no irc connection found"))
         return f._deferred
 
+    def cancel(self, f):
+        """Abort the DCC transfer of f, whether it is still waiting for
+        an offer or already connected."""
+        for network in self.networks.values():
+            for identity in network.identities:
+                for nick in identity.dcc_sessions:
+                    for dcc in identity.dcc_sessions[nick]:
+                        if dcc.file is not f or dcc.state in (DccState.FINISHED, DccState.ERROR):
+                            continue
+                        if dcc.state == DccState.WAITING:
+                            dcc.finish(DccState.ERROR)
+                            f._deferred.errback(defer.CancelledError())
+                        else:
+                            dcc.connector.disconnect()
+                        return True
+        return False
+
 module = {
     "name" : "XdccDownloader",
     "class" : XdccDownloader
@@ -0,0 +1,111 @@
+# twisted imports
+from twisted.internet import reactor, task
+
+# system imports
+import sys
+import time
+import thread
+import threading
+import traceback
+import collections
+
+class Timer(object):
+	def __init__(self, profiler, label):
+		self.profiler = profiler
+		self.label = label
+		self.start = 0.0
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, type, value, tb):
+		self.profiler.record(self.label, time.time() - self.start)
+		return False
+
+class NoTimer(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, tb):
+		return False
+
+class Watchdog(object):
+	"""Measure how late the reactor runs a periodic call, and dump the stack
+	of the reactor thread from a helper thread when it is blocked for more
+	than threshold seconds."""
+
+	def __init__(self, profiler, threshold):
+		self.profiler = profiler
+		self.threshold = threshold
+		self.interval = threshold / 4.0
+		self._thread_id = thread.get_ident()
+		self._tick = None
+		self._expected = None
+		self._dumped = False
+		self._task = None
+		reactor.callWhenRunning(self.start)
+
+	def start(self):
+		self._tick = time.time()
+		self._expected = self._tick + self.interval
+		self._task = task.LoopingCall(self.tick)
+		self._task.start(self.interval, now = False)
+		watcher = threading.Thread(target = self.watch, name = 'reactor watchdog')
+		watcher.daemon = True
+		watcher.start()
+
+	def tick(self):
+		now = time.time()
+		self.profiler.record('reactor lag', now - self._expected)
+		self._expected = now + self.interval
+		self._tick = now
+		self._dumped = False
+
+	def watch(self):
+		while True:
+			time.sleep(self.interval)
+			stalled = time.time() - self._tick
+			if self._dumped or stalled < self.threshold:
+				continue
+			self._dumped = True
+			frame = sys._current_frames().get(self._thread_id)
+			stack = ''.join(traceback.format_stack(frame)) if frame else ''
+			# slow is only touched from the reactor thread, report() iterates it
+			reactor.callFromThread(self.profiler.record, 'reactor stall', stalled, stack)
+			print('Reactor stalled for %.3fs in:\n%s' % (stalled, stack))
+
+class Profiler(object):
+	"""Opt-in instrumentation, enabled by the "profiling" config section.
+
+	Operations slower than threshold seconds are kept in a ring buffer of
+	size entries, shown by the /debug page slowest first.
+	"""
+
+	def __init__(self, config = None):
+		self.enabled = config is not None
+		config = config or {}
+		self.threshold = config.get('threshold', 0.1)
+		self.slow = collections.deque(maxlen = config.get('size', 100))
+		self.watchdog = None
+		if self.enabled and config.get('watchdog', 0.5):
+			self.watchdog = Watchdog(self, config.get('watchdog', 0.5))
+
+	def timed(self, label):
+		if not self.enabled:
+			return NoTimer()
+		return Timer(self, label)
+
+	def record(self, label, duration, stack = None):
+		if duration >= self.threshold:
+			self.slow.append((duration, label, time.time(), stack))
+
+	def report(self):
+		if not self.enabled:
+			return 'Profiling is disabled, add a "profiling" section to the config.\n'
+		lines = []
+		for duration, label, when, stack in sorted(self.slow, reverse = True):
+			lines.append('%8.3fs  %s  %s' % (duration, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)), label))
+			if stack:
+				lines.append(stack)
+		return '\n'.join(lines) + '\n'
@@ -0,0 +1,440 @@
+"""Soak and load harness.
+
+Runs web.Downloader against local stand-ins: an IRC server hosting scripted
+XDCC bots and an HTTP mirror, both with configurable latency and bandwidth.
+It keeps a given number of downloads in flight for the whole run while
+browser-like clients poll /active, and periodically reports throughput,
+memory growth and reactor lag.
+
+The stand-ins and the pollers run in a child process, so the reported lag
+and memory are the Downloader's own (and its workers', when enabled).
+
+    python soak.py --downloads 200 --pollers 20 --duration 3600
+"""
+
+# twisted imports
+from twisted.internet import reactor, protocol, task, stdio
+from twisted.protocols.basic import LineReceiver
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.web.resource import Resource
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+from twisted.words.protocols import irc
+
+# system imports
+import os
+import re
+import gc
+import sys
+import time
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+
+LOCALHOST = 2130706433 # 127.0.0.1 as sent in DCC offers
+SCRIPT = os.path.abspath(__file__)
+
+def rss(pid = 'self'):
+	"""Current resident set size of pid in KiB, 0 once it is gone."""
+	try:
+		return int(open('/proc/%s/statm' % (pid,)).read().split()[1]) * resource.getpagesize() / 1024
+	except IOError:
+		return 0
+
+class DccSender(protocol.Protocol):
+	"""Sends size bytes at rate bytes per second (0 for unthrottled),
+	then closes the connection."""
+
+	def connectionMade(self):
+		self.factory.port.stopListening()
+		self.sent = 0
+		self._task = task.LoopingCall(self.tick)
+		self._task.start(0.1)
+
+	def tick(self):
+		chunk = min(self.factory.rate / 10 or self.factory.size, self.factory.size - self.sent)
+		self.transport.write('\0' * chunk)
+		self.sent += chunk
+		if self.sent >= self.factory.size:
+			self._task.stop()
+			self.transport.loseConnection()
+
+	def dataReceived(self, data):
+		# DCC acknowledgements
+		pass
+
+	def connectionLost(self, reason):
+		if self._task.running:
+			self._task.stop()
+		self.factory.bot.done(self.factory.nick)
+
+class DccSenderFactory(protocol.ServerFactory):
+	protocol = DccSender
+
+	def __init__(self, bot, nick, size, rate):
+		self.bot = bot
+		self.nick = nick
+		self.size = size
+		self.rate = rate
+		self.port = None
+
+class XdccBot(object):
+	"""A scripted XDCC bot, answering "xdcc send #n" with a DCC SEND offer,
+	or with a queue notice when the requesting nick has no free slot."""
+
+	def __init__(self, name, slots, size, rate):
+		self.name = name
+		self.slots = slots
+		self.size = size
+		self.rate = rate
+		self.sending = {}
+		self.queue = []
+		self.offers = 0
+
+	def request(self, client, text):
+		match = re.match(r'xdcc send #?(\d+)', text, re.I)
+		if not match:
+			return
+		if self.sending.get(client.nickname, 0) >= self.slots:
+			self.queue.append((client, match.group(1)))
+			client.notice('%s!bot@soak' % (self.name,), client.nickname, 'All slots full, added to queue position %d' % (len(self.queue),))
+		else:
+			self.send(client, match.group(1))
+
+	def send(self, client, pack):
+		self.sending[client.nickname] = self.sending.get(client.nickname, 0) + 1
+		self.offers += 1
+		factory = DccSenderFactory(self, client.nickname, self.size, self.rate)
+		factory.port = reactor.listenTCP(0, factory, interface = '127.0.0.1')
+		filename = '%s-%s-%d.bin' % (self.name, pack, self.offers)
+		offer = '\x01DCC SEND %s %d %d %d\x01' % (filename, LOCALHOST, factory.port.getHost().port, self.size)
+		client.privmsg('%s!bot@soak' % (self.name,), client.nickname, offer)
+
+	def done(self, nick):
+		self.sending[nick] -= 1
+		for i in range(0, len(self.queue)):
+			client, pack = self.queue[i]
+			if client.nickname == nick:
+				del self.queue[i]
+				self.send(client, pack)
+				break
+
+class FakeIrcServer(irc.IRC):
+	def connectionMade(self):
+		irc.IRC.connectionMade(self)
+		self.nickname = None
+
+	def irc_NICK(self, prefix, params):
+		self.nickname = params[0]
+
+	def irc_USER(self, prefix, params):
+		self.sendMessage(irc.RPL_WELCOME, self.nickname, ':Welcome to the soak network', prefix = 'soak')
+
+	def irc_JOIN(self, prefix, params):
+		for channel in params[0].split(','):
+			self.join('%s!user@soak' % (self.nickname,), channel)
+
+	def irc_PRIVMSG(self, prefix, params):
+		if params[0] in self.factory.bots:
+			self.factory.bots[params[0]].request(self, params[1])
+
+	def irc_unknown(self, prefix, command, params):
+		pass
+
+class FakeIrcFactory(protocol.ServerFactory):
+	protocol = FakeIrcServer
+
+	def __init__(self, bots):
+		self.bots = bots
+
+class Mirror(Resource):
+	"""Serves size bytes for any path, after latency seconds and at rate
+	bytes per second (0 for unthrottled)."""
+
+	isLeaf = True
+
+	def __init__(self, size, latency, rate):
+		Resource.__init__(self)
+		self.size = size
+		self.latency = latency
+		self.rate = rate
+
+	def render_GET(self, request):
+		request.setHeader('content-length', str(self.size))
+		reactor.callLater(self.latency, self.start, request)
+		return NOT_DONE_YET
+
+	def start(self, request):
+		state = {'sent' : 0, 'gone' : False}
+		request.notifyFinish().addErrback(lambda reason: state.update(gone = True))
+		def tick():
+			if state['gone']:
+				sending.stop()
+				return
+			chunk = min(self.rate / 10 or self.size, self.size - state['sent'])
+			request.write('\0' * chunk)
+			state['sent'] += chunk
+			if state['sent'] >= self.size:
+				sending.stop()
+				request.finish()
+		sending = task.LoopingCall(tick)
+		sending.start(0.1)
+
+class Poller(object):
+	"""A browser tab polling /active every interval seconds."""
+
+	def __init__(self, stats, url, interval):
+		self.stats = stats
+		self.url = url
+		self.agent = Agent(reactor)
+		self.etag = None
+		self._task = task.LoopingCall(self.poll)
+		self._task.start(interval)
+
+	def poll(self):
+		headers = Headers({'Accept-Encoding' : ['gzip']})
+		if self.etag:
+			headers.addRawHeader('If-None-Match', self.etag)
+		start = time.time()
+		d = self.agent.request('GET', self.url, headers)
+		d.addCallback(self.response, start)
+		d.addErrback(lambda reason: self.stats.polled('errors', time.time() - start))
+
+	def response(self, response, start):
+		etag = response.headers.getRawHeaders('etag')
+		if etag:
+			self.etag = etag[0]
+		d = readBody(response)
+		d.addCallback(lambda body: self.stats.polled(response.code, time.time() - start))
+		return d
+
+class StandInChannel(LineReceiver):
+	"""Child side of the channel to the soak process, JSON lines on stdio."""
+
+	delimiter = '\n'
+
+	def __init__(self, standins):
+		self.standins = standins
+
+	def send(self, message):
+		self.sendLine(json.dumps(message))
+
+	def connectionMade(self):
+		self.send({'irc' : self.standins.irc_port, 'http' : self.standins.http_port})
+
+	def lineReceived(self, line):
+		self.standins.poll(json.loads(line)['url'].encode('ascii'))
+
+	def connectionLost(self, reason):
+		# the soak process exited
+		if reactor.running:
+			reactor.stop()
+
+class StandIns(object):
+	"""The IRC network, its XDCC bots, the HTTP mirror and the pollers."""
+
+	def __init__(self, args):
+		self.args = args
+		self.polls = {}
+		self.poll_time = 0.0
+		bots = {}
+		for i in range(0, args.bots):
+			bots['bot%d' % (i,)] = XdccBot('bot%d' % (i,), args.slots, args.size, args.rate)
+		self.irc_port = reactor.listenTCP(0, FakeIrcFactory(bots), interface = '127.0.0.1').getHost().port
+		mirror = Mirror(args.size, args.latency, args.rate)
+		self.http_port = reactor.listenTCP(0, Site(mirror), interface = '127.0.0.1').getHost().port
+		self.channel = StandInChannel(self)
+		stdio.StandardIO(self.channel)
+
+	def poll(self, url):
+		for i in range(0, self.args.pollers):
+			Poller(self, url, self.args.poll)
+		self._report = task.LoopingCall(self.report)
+		self._report.start(1.0)
+
+	def polled(self, code, seconds):
+		self.polls[code] = self.polls.get(code, 0) + 1
+		self.poll_time += seconds
+
+	def report(self):
+		self.channel.send({'polls' : self.polls, 'poll_time' : self.poll_time})
+
+class StandInProcess(protocol.ProcessProtocol):
+	"""Soak side of the channel, see StandInChannel."""
+
+	def __init__(self, soak):
+		self.soak = soak
+		self.buffer = ''
+
+	def send(self, message):
+		self.transport.write(json.dumps(message) + '\n')
+
+	def outReceived(self, data):
+		self.buffer += data
+		while '\n' in self.buffer:
+			line, self.buffer = self.buffer.split('\n', 1)
+			message = json.loads(line)
+			if 'irc' in message:
+				self.soak.ready(message['irc'], message['http'])
+			else:
+				self.soak.polls = dict((str(code), count) for code, count in message['polls'].items())
+				self.soak.poll_time = message['poll_time']
+
+	def errReceived(self, data):
+		sys.stderr.write(data)
+
+	def processEnded(self, reason):
+		if reactor.running:
+			print('Stand-ins exited: %s' % (reason.getErrorMessage(),))
+			reactor.stop()
+
+class Soak(object):
+	def __init__(self, web, args):
+		self.web = web
+		self.args = args
+		self.target = tempfile.mkdtemp(prefix = 'pygeon-soak-')
+		self.started = time.time()
+		self.files = set()
+		self.next = 0
+		self.finished = 0
+		self.errors = 0
+		self.bytes = 0
+		self.reported_bytes = 0
+		self.reported_time = self.started
+		self.polls = {}
+		self.poll_time = 0.0
+		self.lag = 0.0
+		self.expected = None
+		self.rss = 0
+		self.workers_rss = 0
+		self.standins = StandInProcess(self)
+		reactor.spawnProcess(self.standins, sys.executable, [sys.executable, SCRIPT, '--stand-ins'] + sys.argv[1:], env = os.environ)
+
+	def ready(self, irc_port, http_port):
+		args = self.args
+		self.http_port = http_port
+		config = {
+			'target' : self.target,
+			'concurrency' : args.downloads,
+			'retries' : 0,
+			'modules' : {
+				'HttpDownloader' : {},
+				'XdccDownloader' : {
+					'nickname' : 'soak',
+					'networks' : {
+						'soak' : {
+							'server' : ['127.0.0.1', irc_port],
+							'channels' : ['xdcc'],
+							'identities' : args.identities,
+						},
+					},
+				},
+			},
+		}
+		if args.workers:
+			for module in config['modules']:
+				config['modules'][module]['worker'] = args.workers
+		self.downloader = self.web.Downloader(config)
+		web_port = reactor.listenTCP(0, Site(self.downloader), interface = '127.0.0.1').getHost().port
+		self.url = 'http://127.0.0.1:%d/active' % (web_port,)
+		self.standins.send({'url' : self.url})
+		reactor.callLater(1.0, self.start)
+
+	def url_for(self, i):
+		if i % 2 and self.args.bots:
+			return u'XdccDownloader:irc://soak/bot%d/xdcc send %d' % (i % self.args.bots, i)
+		return u'HttpDownloader:http://127.0.0.1:%d/file-%d.bin' % (self.http_port, i)
+
+	def worker_pids(self):
+		return [worker.pid for module in self.downloader.enabled.values() for worker in getattr(module, 'workers', [])]
+
+	def start(self):
+		# growth is measured from here, once the workers are up
+		self.rss = rss()
+		self.workers_rss = sum(rss(pid) for pid in self.worker_pids())
+		self._lag = task.LoopingCall(self.measure_lag)
+		self._lag.start(0.1)
+		self._refill = task.LoopingCall(self.refill)
+		self._refill.start(0.5)
+		self._report = task.LoopingCall(self.report)
+		self._report.start(self.args.report, now = False)
+		reactor.callLater(self.args.duration, self.stop)
+
+	def measure_lag(self):
+		now = time.time()
+		if self.expected is not None:
+			self.lag = max(self.lag, now - self.expected)
+		self.expected = now + 0.1
+
+	def refill(self):
+		for f in list(self.files):
+			if f.state().done():
+				self.files.remove(f)
+				self.bytes += f._received
+				if f.state().equal('FINISHED'):
+					self.finished += 1
+				else:
+					self.errors += 1
+				if f.path() and os.path.exists(f.path()):
+					os.remove(f.path())
+		urls = []
+		while len(self.files) + len(urls) < self.args.downloads:
+			urls.append(self.url_for(self.next))
+			self.next += 1
+		if urls:
+			result = self.downloader.api_enqueue({'urls' : urls})
+			for entry in result['files']:
+				self.files.add(self.downloader.queue._entries[entry['id']].file)
+
+	def report(self):
+		now = time.time()
+		received = self.bytes + sum(f._received for f in self.files)
+		throughput = (received - self.reported_bytes) / (now - self.reported_time) / 2**20
+		polls = sum(self.polls.values())
+		workers_rss = sum(rss(pid) for pid in self.worker_pids())
+		print('[%6ds] %7.2f MiB/s  running %d  finished %d  errors %d  rss %+d KiB  workers %+d KiB  objects %d  max lag %.3fs  polls %s (%.3fs avg)' % (
+			now - self.started, throughput, self.downloader.queue.running(), self.finished, self.errors,
+			rss() - self.rss, workers_rss - self.workers_rss, len(gc.get_objects()), self.lag,
+			self.polls, self.poll_time / polls if polls else 0.0,
+		))
+		sys.stdout.flush()
+		self.reported_bytes = received
+		self.reported_time = now
+		self.lag = 0.0
+
+	def stop(self):
+		self._report.stop()
+		# unless the periodic report just ran in this same tick
+		if time.time() - self.reported_time > self.args.report / 10.0:
+			self.report()
+		shutil.rmtree(self.target, ignore_errors = True)
+		reactor.stop()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+	parser.add_argument('--downloads', type = int, default = 100, help = 'downloads kept in flight')
+	parser.add_argument('--pollers', type = int, default = 10, help = 'clients polling /active')
+	parser.add_argument('--poll', type = float, default = 2.0, help = 'poll interval in seconds')
+	parser.add_argument('--duration', type = float, default = 600.0, help = 'run time in seconds')
+	parser.add_argument('--report', type = float, default = 10.0, help = 'report interval in seconds')
+	parser.add_argument('--size', type = int, default = 2**20, help = 'bytes per file')
+	parser.add_argument('--rate', type = int, default = 256 * 2**10, help = 'bytes per second per transfer, 0 for unthrottled')
+	parser.add_argument('--latency', type = float, default = 0.2, help = 'HTTP mirror latency in seconds')
+	parser.add_argument('--bots', type = int, default = 4, help = 'XDCC bots, 0 for HTTP only')
+	parser.add_argument('--slots', type = int, default = 2, help = 'XDCC transfers per nick and bot')
+	parser.add_argument('--identities', type = int, default = 4, help = 'IRC identities')
+	parser.add_argument('--workers', type = int, default = 0, help = 'worker processes per module, 0 to run in process')
+	parser.add_argument('--stand-ins', action = 'store_true', help = argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	os.chdir(os.path.dirname(SCRIPT))
+	if args.stand_ins:
+		StandIns(args)
+	else:
+		import web
+		web.Downloader.loadModules()
+		web.Downloader.loadTriggers()
+		Soak(web, args)
+	reactor.run()
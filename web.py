@@ -3,8 +3,9 @@ from twisted.web.server import Site
 from twisted.web.resource import Resource, NoResource, getChildForRequest
 from twisted.web.util import redirectTo
 from twisted.internet import reactor, task, defer
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.web.static import File
+from twisted.web import http
 
 # system imports
 import time
@@ -19,14 +20,33 @@ import urllib
 import string
 import shutil
 import importlib
+import collections
+import ast
+import hashlib
+import zlib
 
 # template imports
 import jinja2
 
+# worker processes
+from workers import WorkerPool
+
+# instrumentation
+from profiling import Profiler
+
 class RequestRedirection(Exception):
     pass
 
-class FileState:
+class StaticFile(File):
+	"""Static assets, cached by browsers for max_age seconds."""
+	max_age = 30 * 24 * 3600
+
+	def render(self, request):
+		request.setHeader('Cache-Control', 'public, max-age=%d' % (self.max_age,))
+		return File.render(self, request)
+
+class FileState(object):
+    __slots__ = ('_file', '_status')
     states = ["WAITING", "REQUESTED", "DOWNLOADING", "FINISHED", "ERROR"]
 
     def __init__(self, file):
@@ -45,7 +65,8 @@ class FileState:
     	if event in self._file._triggers:
     		for name in self._file._triggers[event]:
     			trigger = self._file._manager.triggers['enabled'][name]
-    			getattr(trigger, event)(self._file)
+    			with self._file._manager.profiler.timed('trigger %s %s' % (name, event)):
+    				getattr(trigger, event)(self._file)
 
     def equal(self, state):
     	return self._status == self.states.index(state)
@@ -53,11 +74,108 @@ class FileState:
     def active(self):
     	return self.equal('REQUESTED') or self.equal('DOWNLOADING')
 
+    def done(self):
+    	return self.equal('FINISHED') or self.equal('ERROR')
+
 	def __repr__(self):
 		return ("<%s at %x: %s>" % (self.__class__, id(self), self.status()))
 
-class DownloaderFile:
-	def __init__(self, manager, url, target, name = '', filename = '', size = None, temp = False, triggers = {}):
+class WaitingState(FileState):
+	"""The state of listing rows not materialized into files yet, always
+	WAITING. A single instance is shared by all of them."""
+	__slots__ = ()
+
+	def set(self, status):
+		raise TypeError('a listing row has no state of its own')
+
+def parse_size(str):
+	int_part = ''
+	while str and str[0] in string.digits:
+		int_part += str[0]
+		str = str[1:]
+	if str and str[0] == '.':
+		int_part += str[0]
+		str = str[1:]
+		while str and str[0] in string.digits:
+			int_part += str[0]
+			str = str[1:]
+	size = float(int_part)
+	unite = {
+		'kio' : 2**10, 'mio' : 2**20, 'gio' : 2**30, 'tio' : 2**40, 'pio' : 2**50, 'eio' : 2**60, 'zio' : 2**70,
+		'ko' : 10**3, 'mo' : 10**6, 'go' : 10**9, 'to' : 10**12, 'po' : 10**15, 'eo' : 10**18, 'zo' : 10**21,
+	}
+	if str:
+		if str.lower() in unite:
+			size *= unite[str.lower()]
+		else:
+			size *= unite[str.lower()+'o']
+	return int(size)
+
+def safe_name(path):
+	"""File name of a quoted url path, ValueError if it could escape the
+	target directory."""
+	name = os.path.basename(urllib.unquote(path)).decode('utf-8')
+	if not name or os.sep in name or '..' in name:
+		raise ValueError('invalid file name %r' % (name,))
+	return name
+
+def size_fmt(num, suffix='B'):
+	if num is None:
+		return ''
+	for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+		if abs(num) < 1024.0:
+			return "%3.1f%s%s" % (num, unit, suffix)
+		num /= 1024.0
+	return "%.1f%s%s" % (num, 'Yi', suffix)
+
+class PeerStats(object):
+	"""Throughput and error rate of each host, or each bot for IRC urls,
+	used to rank the urls a file can be downloaded from."""
+
+	def __init__(self):
+		# peer -> [bytes, seconds, successes, errors]
+		self._peers = {}
+
+	@staticmethod
+	def peer(url):
+		parsed = urlparse.urlparse(url.split(':', 1)[1])
+		if parsed.scheme == 'irc':
+			return '%s/%s' % (parsed.netloc, parsed.path.strip('/').split('/')[0])
+		return parsed.netloc
+
+	def record(self, url, received, seconds, good):
+		stats = self._peers.setdefault(self.peer(url), [0, 0.0, 0, 0])
+		stats[0] += received
+		stats[1] += seconds
+		stats[2 if good else 3] += 1
+
+	def throughput(self, peer):
+		stats = self._peers.get(peer)
+		if not stats or not stats[1]:
+			return None
+		return stats[0] / stats[1]
+
+	def score(self, url, default):
+		stats = self._peers.get(self.peer(url), [0, 0.0, 0, 0])
+		throughput = self.throughput(self.peer(url)) or default
+		return throughput * (stats[2] + 1.0) / (stats[2] + stats[3] + 2.0)
+
+	def rank(self, urls):
+		"""Sort urls best first, unknown peers are assumed to be average."""
+		known = [self.throughput(peer) for peer in self._peers if self.throughput(peer)]
+		default = sum(known) / len(known) if known else 1.0
+		return sorted(urls, key = lambda url: -self.score(url, default))
+
+class DownloaderFile(object):
+	__slots__ = (
+		'_manager', '_module', '_url', '_target', '_name', '_filename',
+		'_received', '_size', '_temp', '_download_time', '_success', '_error',
+		'_start_time', '_end_time', '_good', '_active', '_state', '_fd',
+		'_triggers', '_deferred', '_path', '_mirrors', '_attempts', '_retry',
+		'_offset', '_abort', '_watch', '_last_received',
+	)
+
+	def __init__(self, manager, url, target, name = '', filename = '', size = None, temp = False, triggers = {}, mirrors = ()):
 		self._manager = manager
 		self._module, self._url = url.encode('ascii').split(':', 1)
 		self._target = target
@@ -65,7 +183,7 @@ class DownloaderFile:
 		self._filename = filename
 		self._received = 0
 		if size:
-			self._size = self.parse_size(size)
+			self._size = parse_size(size)
 		else:
 			self._size = None
 		self._temp = temp
@@ -79,17 +197,34 @@ class DownloaderFile:
 		self._state = FileState(self)
 		self._fd = None
 		self._triggers = triggers
+		self._deferred = None
+		self._path = None
+		self._mirrors = tuple(mirror.encode('ascii') for mirror in mirrors)
+		self._attempts = 0
+		self._retry = None
+		self._offset = 0
+		self._abort = None
+		self._watch = None
+		self._last_received = 0
 
-	def open(self, filename  = ''):
+	def open(self, filename  = '', append = False):
 		if filename:
 			self._filename = filename
 		else:
 			self._filename = self._name
 		if self._temp:
 			self._fd = tempfile.NamedTemporaryFile(delete = False)
+			self._received = 0
+		elif append:
+			self._manager.active.add(self)
+			self._fd = open(os.path.join(self._target, self._filename), 'ab')
+			self._received = os.path.getsize(self._fd.name)
 		else:
-			self._manager.active.files.append(self)
+			self._manager.active.add(self)
 			self._fd = open(os.path.join(self._target, self._filename), 'wb')
+			self._received = 0
+		self._path = self._fd.name
+		self._offset = self._received
 		self.state().set("DOWNLOADING")
 		return self
 
@@ -103,35 +238,136 @@ class DownloaderFile:
 	def move(self, target):
 		shutil.move(os.path.join(self._target, self._filename), os.path.join(target, self._filename))
 		self._target = target
+		self._path = os.path.join(target, self._filename)
 
 	def download(self, success = None, error = None):
 		self._good = False
 		self._success = success
 		self._error = error
-		self._start_time = time.time()
 		self._active = True
+		self._attempts = 0
 		self.state().set("REQUESTED")
-		self._deferred = self._manager.enabled[self._module].download(self)
-		self._deferred.addCallback(self.success).addErrback(self.error)
+		self.select()
+		self.start()
+
+	def start(self):
+		self._retry = None
+		self._start_time = time.time()
+		self._offset = self._received
+		# a missing module, or one raising instead of failing its deferred,
+		# goes through error() too
+		self._deferred = defer.maybeDeferred(self.request)
+		# errors of success() itself, a failing trigger say, are not transfer errors
+		self._deferred.addCallbacks(self.success, self.error)
+
+	def request(self):
+		if self._module not in self._manager.enabled:
+			raise KeyError('Module %s is not enabled' % (self._module,))
+		module = self._manager.enabled[self._module]
+		timeout = getattr(module, 'timeouts', {}).get('progress')
+		if timeout:
+			self._last_received = self._received
+			self._watch = task.LoopingCall(self.watch)
+			self._watch.clock = self._manager.clock
+			self._watch.start(timeout, now = False)
+		return module.download(self)
+
+	def candidates(self):
+		"""Urls this file can be downloaded from, with an enabled module."""
+		urls = []
+		for url in ('%s:%s' % (self._module, self._url),) + self._mirrors:
+			if url not in urls and url.split(':', 1)[0] in self._manager.enabled:
+				urls.append(url)
+		return urls
+
+	def select(self):
+		urls = self._manager.peers.rank(self.candidates())
+		if urls:
+			self._module, self._url = urls[0].split(':', 1)
+
+	def failover(self, d):
+		"""Retry on the best ranked url after an exponential backoff,
+		returns False once out of attempts."""
+		if self._attempts >= self._manager.retries:
+			return False
+		self._attempts += 1
+		self.select()
+		delay = min(self._manager.retry_delay * 2 ** (self._attempts - 1), self._manager.retry_max_delay)
+		print('retrying %s in %ds (attempt %d)' % (self._url, delay, self._attempts))
+		self._retry = self._manager.clock.callLater(delay, self.start)
+		return True
+
+	def record(self, good):
+		"""Account this attempt, the bytes resumed from a previous one excluded."""
+		received = max(0, self._received - self._offset)
+		self._manager.peers.record('%s:%s' % (self._module, self._url), received, time.time() - self._start_time, good)
+
+	def watch(self):
+		"""Abort the transfer when no data arrived since the previous call."""
+		if not self.state().equal('DOWNLOADING') or self._received != self._last_received:
+			self._last_received = self._received
+			return
+		self.abort(defer.TimeoutError('no progress for %gs' % (self._watch.interval,)))
+
+	def unwatch(self):
+		if self._watch is not None:
+			if self._watch.running:
+				self._watch.stop()
+			self._watch = None
 
 	def success(self, d):
 		print('success')
+		self.unwatch()
+		self.record(True)
 		self._active = False
 		self._good = True
 		self._end_time = time.time()
 		self.state().set("FINISHED")
+		if not self._temp:
+			self._manager.active.archive(self)
 		if callable(self._success):
 			self._success(d)
 
 	def error(self, d):
+		self.unwatch()
+		if self._abort is not None:
+			d, self._abort = self._abort, None
 		print('error: %s' % (d,))
+		if not isinstance(d, failure.Failure):
+			d = failure.Failure(d)
+		if not d.check(defer.CancelledError):
+			self.record(False)
+			if self.failover(d):
+				return
 		self._active = False
 		self._good = False
 		self._end_time = time.time()
 		self.state().set("ERROR")
+		if not self._temp:
+			self._manager.active.archive(self)
 		if callable(self._error):
 			self._error(d)
 
+	def abort(self, reason):
+		"""Tear the download down through its module, it then fails with
+		reason instead of the error the teardown itself produces."""
+		if self._retry is not None:
+			self._retry.cancel()
+			self._retry = None
+			self.error(reason)
+			return True
+		module = self._manager.enabled[self._module]
+		if not hasattr(module, 'cancel'):
+			return False
+		self._abort = reason
+		if not module.cancel(self):
+			self._abort = None
+			return False
+		return True
+
+	def cancel(self):
+		return self.abort(defer.CancelledError())
+
 	def active(self):
 		return self._active
 
@@ -150,93 +386,187 @@ class DownloaderFile:
 		return int(100.0 * self._received / self._size)
 
 	def size_fmt(self, suffix='B'):
-		num = self._size
-		for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-			if abs(num) < 1024.0:
-				return "%3.1f%s%s" % (num, unit, suffix)
-			num /= 1024.0
-		return "%.1f%s%s" % (num, 'Yi', suffix)
+		return size_fmt(self._size, suffix)
 
 	def parse_size(self, str):
-		int_part = ''
-		while str and str[0] in string.digits:
-			int_part += str[0]
-			str = str[1:]
-		if str and str[0] == '.':
-			int_part += str[0]
-			str = str[1:]
-			while str and str[0] in string.digits:
-				int_part += str[0]
-				str = str[1:]
-		size = float(int_part)
-		unite = {
-			'kio' : 2**10, 'mio' : 2**20, 'gio' : 2**30, 'tio' : 2**40, 'pio' : 2**50, 'eio' : 2**60, 'zio' : 2**70,
-			'ko' : 10**3, 'mo' : 10**6, 'go' : 10**9, 'to' : 10**12, 'po' : 10**15, 'eo' : 10**18, 'zo' : 10**21,
-		}
-		if str:
-			if str.lower() in unite:
-				size *= unite[str.lower()]
-			else:
-				size *= unite[str.lower()+'o']
-		return int(size)
+		return parse_size(str)
 
 	def fd(self):
 		return self._fd
 
+	def path(self):
+		return self._path
+
 	def realpath(self):
-		return os.path.realpath(self._fd.name)
+		return os.path.realpath(self._path)
+
+class SourceEntry(object):
+	"""Read-only view of a listing row that has not been materialized
+	into a DownloaderFile yet."""
+	__slots__ = ('_name', '_url', '_size')
+	waiting = WaitingState(None)
+
+	def __init__(self, name, url, size):
+		self._name = name
+		self._url = url.split(':', 1)[1]
+		self._size = parse_size(size) if size else None
+
+	def url(self):
+		return self._url
+
+	def state(self):
+		return self.waiting
+
+	def progress(self):
+		return 0
+
+	def size_fmt(self, suffix='B'):
+		return size_fmt(self._size, suffix)
+
+	def path(self):
+		return None
+
+class Listing(object):
+	"""A listing page, shared by every source using the same url.
+
+	Fetches are single-flight: a refresh while the page is downloading waits
+	for that download, and one within ttl seconds of the last successful
+	download reuses its body unless forced. Each distinct pattern runs once
+	per body.
+	"""
+
+	def __init__(self, manager, url, ttl):
+		self._file = DownloaderFile(manager, url, '/tmp', temp = True)
+		self._ttl = ttl
+		self._data = None
+		self._fetched = 0.0
+		self._matches = {}
+		self._waiting = []
+
+	def file(self):
+		return self._file
+
+	def fetch(self, force = False):
+		d = defer.Deferred()
+		if not force and self._data is not None and not self._file.active() and time.time() - self._fetched < self._ttl:
+			d.callback(self)
+			return d
+		self._waiting.append(d)
+		if not self._file.active():
+			self._file.download(self.success, self.error)
+		return d
 
-class DownloaderSource:
-	files = []
+	def success(self, d):
+		fd = open(self._file.path())
+		self._data = fd.read()
+		fd.close()
+		os.remove(self._file.path())
+		self._fetched = time.time()
+		self._matches = {}
+		waiting, self._waiting = self._waiting, []
+		for d in waiting:
+			d.callback(self)
+
+	def error(self, d):
+		waiting, self._waiting = self._waiting, []
+		for waiter in waiting:
+			waiter.errback(d)
+
+	def findall(self, pattern):
+		if pattern.pattern not in self._matches:
+			self._matches[pattern.pattern] = pattern.findall(self._data)
+		return self._matches[pattern.pattern]
 
+class DownloaderSource(object):
 	def __init__(self, manager, name, config):
 		self._manager = manager
 		self._name = name
 		self._target = config['target']
-		self._file = DownloaderFile(self._manager, config['source'], '/tmp', temp = True)
+		self._listing = manager.listing(config['source'])
+		# shared with the other sources of the listing, for state() and last_update()
+		self._file = self._listing.file()
 		self._refresh = config.get('refresh', 0.0)
 		self._pattern = config['pattern']
 		self._re_pattern = re.compile(self._pattern, re.UNICODE)
 		self._url = config['url']
 		self._filename = config.get('filename', '')
 		self._filesize = config.get('filesize', '')
+		self._mirrors = config.get('mirrors', [])
 		self._task = None
 		self._triggers = {}
 		for trigger in config.get('triggers', {}):
 			self._triggers[trigger.lower()] = config['triggers'][trigger]
+		# listing rows as (name, url, size, mirrors) tuples, see entry()/file()
+		self._entries = []
+		# DownloaderFile instances materialized from rows, keyed by url
+		self._files = {}
 
 		self.refresh_loop()
 
-	def refresh_loop(self):
+	def refresh_loop(self, force = False):
 		if self._task:
 			self._task.stop()
 			self._task = None
 		if self._refresh > 0.0:
 			self._task = task.LoopingCall(self.refresh)
-			self._task.start(int(self._refresh*60), now = True)
-		else:
-			self.refresh()
+			self._task.start(int(self._refresh*60), now = False)
+		self.refresh(force)
 
-	def refresh(self):
-		self._file.download(self.success, self.error)
+	def refresh(self, force = False):
+		"""Scan the listing, force skips the body cached by periodic refreshes."""
+		self._listing.fetch(force).addCallbacks(self.success, self.error)
 
-	def success(self, d):
-		fd = open(self._file._fd.name)
-		self.data = fd.read()
-		fd.close()
-		os.remove(self._file._fd.name)
-		
-		config = {'triggers':self._triggers}
-		files = []
-		for match in self._re_pattern.findall(self.data):
-			match = [m.decode('utf-8') for m in match]
-			url = self._url.format(*match)
-			config['name'] = self._filename.format(*match)
-			if self._filesize:
-				config['size'] = self._filesize.format(*match)
-			#print(config)
-			files.append(DownloaderFile(self._manager, url, self._target, **config))
-		self.files = files
+	def success(self, listing):
+		entries = []
+		with self._manager.profiler.timed('source %s scan' % (self._name,)):
+			for match in listing.findall(self._re_pattern):
+				match = [m.decode('utf-8') for m in match]
+				entries.append((
+					self._filename.format(*match),
+					self._url.format(*match),
+					self._filesize.format(*match) if self._filesize else None,
+					tuple(mirror.format(*match) for mirror in self._mirrors),
+				))
+		self._entries = entries
+
+		# only keep materialized files still listed or still running
+		urls = set(entry[1] for entry in entries)
+		for url in self._files.keys():
+			if url not in urls and not self._files[url].active():
+				del self._files[url]
+
+	def count(self):
+		return len(self._entries)
+
+	def entry(self, i):
+		name, url, size, mirrors = self._entries[i]
+		if url in self._files:
+			return self._files[url]
+		return SourceEntry(name, url, size)
+
+	def entries(self):
+		return [self.entry(i) for i in range(0, self.count())]
+
+	def search(self, pattern):
+		return [i for i in range(0, self.count()) if pattern.search(self._entries[i][0])]
+
+	def urls(self, name):
+		"""Every url listed for name, including mirrors."""
+		urls = []
+		for entry in self._entries:
+			if entry[0] == name:
+				urls += (entry[1],) + entry[3]
+		return urls
+
+	def file(self, i):
+		name, url, size, mirrors = self._entries[i]
+		if url not in self._files:
+			mirrors = list(mirrors)
+			for source in self._manager.sources.values():
+				if source is not self:
+					mirrors += source.urls(name)
+			self._files[url] = DownloaderFile(self._manager, url, self._target, name = name, size = size, triggers = self._triggers, mirrors = mirrors)
+		return self._files[url]
 
 	def error(self, d):
 		print('error: ' + str(d))
@@ -252,15 +582,16 @@ class DownloaderSource:
 		if len(path) > 0:
 			if path[0] == 'download':
 				try:
-					self.files[int(path[1])].download()
-				except ValueError,IndexError:
+					self._manager.queue.enqueue(self.file(int(path[1])))
+					self._manager.queue.schedule()
+				except (ValueError, IndexError):
 					pass
 			elif path == ['refresh']:
 				print('Refreshing:',self.state().status())
 				if not self.state().active():
-					self.refresh_loop()
+					self.refresh_loop(force = True)
 				raise RequestRedirection('/source/' + urllib.quote(self.name()) + '/')
-		return self._manager.jinja.get_template('source.html').render(app=self._manager, source=self)
+		return self._manager.render_template('source.html', app=self._manager, source=self)
 
 	def state(self):
 		return self._file.state()
@@ -269,18 +600,201 @@ class DownloaderSource:
 		return id(self)
 
 class ActiveSource(DownloaderSource):
-	def __init__(self):
+	history = 100
+
+	def __init__(self, history = history):
 		self._name = 'Active Downloads'
+		self._files = []
+		self._history = collections.deque(maxlen = history)
+
+	def add(self, f):
+		if f in self._history:
+			self._history.remove(f)
+		if f not in self._files:
+			self._files.append(f)
+
+	def archive(self, f):
+		if f in self._files:
+			self._files.remove(f)
+		self._history.appendleft(f)
+
+	def count(self):
+		return len(self._files) + len(self._history)
+
+	def entry(self, i):
+		if i < len(self._files):
+			return self._files[i]
+		return self._history[i - len(self._files)]
+
+	def entries(self):
+		return self._files + list(self._history)
+
+	def file(self, i):
+		return self.entry(i)
 
 	def last_update(self):
 		return datetime.datetime.fromtimestamp(time.time())
 
+class QueueEntry(object):
+	__slots__ = ('id', 'file', 'priority', 'paused')
+
+	def __init__(self, id, file, priority, paused):
+		self.id = id
+		self.file = file
+		self.priority = priority
+		self.paused = paused
+
+class DownloadQueue(object):
+	"""Downloads requested from the web UI or the JSON API.
+
+	Waiting files are started highest priority first, as long as fewer than
+	concurrency downloads are running (0 means no limit). Entry ids only
+	grow, so they double as listing cursors.
+	"""
+
+	def __init__(self, concurrency = 0, history = ActiveSource.history):
+		self.concurrency = concurrency
+		self.history = history
+		self._entries = collections.OrderedDict()
+		self._ids = {}
+		self._next = 0
+		self._scheduling = False
+		self._pending = False
+
+	def enqueue(self, f, priority = 0, paused = False):
+		if id(f) in self._ids:
+			entry = self._entries[self._ids[id(f)]]
+			self.retry(entry)
+			return entry
+		entry = QueueEntry(self._next, f, priority, paused)
+		self._next += 1
+		self._entries[entry.id] = entry
+		self._ids[id(f)] = entry.id
+		return entry
+
+	def running(self):
+		return len([entry for entry in self._entries.values() if entry.file.active()])
+
+	def schedule(self):
+		# downloads ending synchronously call back into schedule() through
+		# done(), run another pass instead of recursing once per entry
+		if self._scheduling:
+			self._pending = True
+			return
+		self._scheduling = True
+		try:
+			self._pending = True
+			while self._pending:
+				self._pending = False
+				waiting = [entry for entry in self._entries.values() if not entry.paused and entry.file.state().equal('WAITING')]
+				waiting.sort(key = lambda entry: (-entry.priority, entry.id))
+				for entry in waiting:
+					if self.concurrency and self.running() >= self.concurrency:
+						break
+					# callbacks of an earlier download may have changed it
+					if entry.file.state().equal('WAITING'):
+						entry.file.download(self.done, self.done)
+		finally:
+			self._scheduling = False
+
+	def done(self, d):
+		self.prune()
+		self.schedule()
+
+	def prune(self):
+		done = [entry for entry in self._entries.values() if entry.file.state().done()]
+		for entry in done[:max(0, len(done) - self.history)]:
+			del self._entries[entry.id]
+			del self._ids[id(entry.file)]
+
+	def pause(self, entry):
+		if not entry.file.state().equal('WAITING'):
+			return False
+		entry.paused = True
+		return True
+
+	def resume(self, entry):
+		if not entry.paused:
+			return False
+		entry.paused = False
+		return True
+
+	def cancel(self, entry):
+		if entry.file.active():
+			return entry.file.cancel()
+		if entry.file.state().equal('WAITING'):
+			entry.file.error(defer.CancelledError())
+			return True
+		return False
+
+	def retry(self, entry):
+		if entry.file.active() or entry.file.state().equal('WAITING'):
+			return False
+		entry.file._received = 0
+		entry.file.state().set('WAITING')
+		return True
+
+	def prioritize(self, entry, priority):
+		entry.priority = int(priority)
+		return True
+
+	def control(self, action, ids, priority = None):
+		"""Apply action to the entries in ids, returns the ids it applied
+		to and the ones it did not (unknown or in the wrong state)."""
+		actions = {
+			'pause' : self.pause,
+			'resume' : self.resume,
+			'cancel' : self.cancel,
+			'retry' : self.retry,
+			'priority' : lambda entry: self.prioritize(entry, priority),
+		}
+		done, skipped = [], []
+		for i in ids:
+			entry = self._entries.get(int(i))
+			if entry is not None and actions[action](entry):
+				done.append(entry.id)
+			else:
+				skipped.append(i)
+		self.schedule()
+		return {'files' : done, 'skipped' : skipped}
+
+	def describe(self, entry):
+		f = entry.file
+		return {
+			'id' : entry.id,
+			'name' : f._name,
+			'url' : '%s:%s' % (f._module, f._url),
+			'state' : str(f.state()),
+			'priority' : entry.priority,
+			'paused' : entry.paused,
+			'size' : f._size,
+			'received' : f._received,
+			'progress' : f.progress(),
+		}
+
+	def list(self, cursor = -1, limit = 100, state = None):
+		entries = []
+		for entry in self._entries.values():
+			if entry.id <= cursor or (state and str(entry.file.state()) != state):
+				continue
+			entries.append(entry)
+			if len(entries) == limit:
+				break
+		return {
+			'files' : [self.describe(entry) for entry in entries],
+			'cursor' : entries[-1].id if len(entries) == limit else None,
+		}
+
 class Downloader(Resource):
 	modules = {}
 	triggers = {"available":{}, "enabled":{}}
 	schemes = {}
 	sources = {}
 	active = ActiveSource()
+	# timers of downloads and modules, a task.Clock in tests
+	clock = reactor
+	# templates of the app, the loader also sees whatever lands in the cwd
+	templates = ['index.html', 'active.html', 'source.html', 'file_list.html', 'download.html', 'modules/irc.html']
 	#isLeaf = True
 
 	@classmethod
@@ -291,26 +805,78 @@ class Downloader(Resource):
 
 	@staticmethod
 	def listModules(dirname):
+		"""Find the plugins of dirname without importing them.
+
+		Returns (name, import path) pairs, the name is read from the
+		"name" entry of the plugin's module dict.
+		"""
 		modules = []
-		for name in os.listdir(dirname):
-			if name.endswith('.py') and name != '__init__.py':
-				modules.append(importlib.import_module('%s.%s' % (dirname, name[:-3])))
+		for filename in os.listdir(dirname):
+			if filename.endswith('.py') and filename != '__init__.py':
+				tree = ast.parse(open(os.path.join(dirname, filename)).read(), filename)
+				for node in tree.body:
+					if not isinstance(node, ast.Assign) or not isinstance(node.value, ast.Dict):
+						continue
+					if [getattr(target, 'id', None) for target in node.targets] != ['module']:
+						continue
+					for key, value in zip(node.value.keys, node.value.values):
+						if isinstance(key, ast.Str) and key.s == 'name' and isinstance(value, ast.Str):
+							modules.append((value.s, '%s.%s' % (dirname, filename[:-3])))
 		return modules
 
+	@staticmethod
+	def resolve(plugins, name):
+		"""Import a plugin registered by listModules on first use."""
+		if isinstance(plugins[name], basestring):
+			plugins[name] = importlib.import_module(plugins[name]).module['class']
+		return plugins[name]
+
 	@classmethod
 	def loadModules(cls):
-		for module in cls.listModules('modules'):
-			cls.register(module.module['name'], module.module['class'])
+		for name, path in cls.listModules('modules'):
+			cls.register(name, path)
 
 	@classmethod
 	def loadTriggers(cls):
-		for module in cls.listModules('triggers'):
-			cls.triggers['available'][module.module['name']] = module.module['class']
+		for name, path in cls.listModules('triggers'):
+			cls.triggers['available'][name] = path
+
+	@classmethod
+	def module(cls, name):
+		return cls.resolve(cls.modules, name)
+
+	@classmethod
+	def trigger(cls, name):
+		return cls.resolve(cls.triggers['available'], name)
 
 	def __init__(self, config = {}):
 		print('Downloader.__init__')
 		Resource.__init__(self)
-		self.jinja = jinja2.Environment(loader=jinja2.FileSystemLoader('.'))
+		templates = config.get('templates', {})
+		if templates.get('cache'):
+			if not os.path.isdir(templates['cache']):
+				os.makedirs(templates['cache'])
+			bytecode_cache = jinja2.FileSystemBytecodeCache(templates['cache'])
+		else:
+			bytecode_cache = None
+		self.jinja = jinja2.Environment(
+			loader=jinja2.FileSystemLoader('.'),
+			auto_reload=templates.get('auto_reload', True),
+			bytecode_cache=bytecode_cache,
+		)
+		# compile the templates upfront instead of on the first request
+		for name in self.templates:
+			self.jinja.get_template(name)
+		self.active = ActiveSource(config.get('history', ActiveSource.history))
+		self.queue = DownloadQueue(config.get('concurrency', 0), config.get('history', ActiveSource.history))
+		self.target = config.get('target', '.')
+		self.profiler = Profiler(config.get('profiling'))
+		self.peers = PeerStats()
+		self.retries = config.get('retries', 3)
+		self.retry_delay = config.get('retry_delay', 10)
+		self.retry_max_delay = config.get('retry_max_delay', 600)
+		self.listings = {}
+		self.listing_ttl = config.get('listing_ttl', 30)
 
 		self.enabled = {}
 		if 'modules' in config:
@@ -319,13 +885,13 @@ class Downloader(Resource):
 				print(module.encode('ascii'))
 				#self.putChild(module.encode('ascii'), self.enabled[module.encode('ascii')])
 		#self.putChild('module', self)
-		self.putChild("static", File("static"))
+		self.putChild("static", StaticFile("static"))
 
 		if 'triggers' in config:
 			for trigger_type in config['triggers']:
 				for trigger_name in config['triggers'][trigger_type]:
 					trigger = config['triggers'][trigger_type][trigger_name]
-					self.triggers['enabled'][trigger_name] = self.triggers['available'][trigger_type](trigger)
+					self.triggers['enabled'][trigger_name] = self.trigger(trigger_type)(trigger)
 				#self.triggers['enabled'][name] = self.triggers['available'][trigger['type']](trigger)
 		print(self.triggers)
 
@@ -336,10 +902,18 @@ class Downloader(Resource):
 				self.sources[source] = DownloaderSource(self, source, config['sources'][source])
 		print(self.sources)
 
+	def listing(self, url):
+		if url not in self.listings:
+			self.listings[url] = Listing(self, url, self.listing_ttl)
+		return self.listings[url]
+
 	def enable(self, name, config):
 		if name in self.enabled:
-			raise KeyError('Module %s is already enabled' % (module,))
-		self.enabled[name] = self.modules[name](self, config)
+			raise KeyError('Module %s is already enabled' % (name,))
+		if config.get('worker', False):
+			self.enabled[name] = WorkerPool(self, name, self.module(name), config)
+		else:
+			self.enabled[name] = self.module(name)(self, config)
 
 	def getChildForLeafRequest(self, request):
 		self.isLeaf = False
@@ -350,11 +924,24 @@ class Downloader(Resource):
 	def getChild(self, path, request):
 		return self
 
+	def render_template(self, name, **context):
+		with self.profiler.timed('template %s' % (name,)):
+			return self.jinja.get_template(name).render(**context)
+
 	def render(self, request):
+		with self.profiler.timed('render /%s' % ('/'.join(request.prepath),)):
+			return self.dispatch(request)
+
+	def dispatch(self, request):
 		#request.setHeader("Content-Type", "text/plain; charset=utf-8")
 		content = ''
 		try:
-			if len(request.prepath) >= 2 and request.prepath[0] == 'module' and request.prepath[1] in self.enabled:
+			if request.prepath == ['debug']:
+				request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+				return self.profiler.report()
+			elif request.prepath[0:1] == ['api']:
+				return self.render_api(request, request.prepath[1:])
+			elif len(request.prepath) >= 2 and request.prepath[0] == 'module' and request.prepath[1] in self.enabled:
 				module = request.prepath[1]
 				path = request.prepath[2:]
 
@@ -365,22 +952,396 @@ class Downloader(Resource):
 			elif len(request.prepath) >= 2 and request.prepath[0] == 'source' and request.prepath[1] in self.sources:
 				content = self.sources[request.prepath[1]].render(request.prepath[2:])
 			elif request.prepath == ['download']:
-				content = self.jinja.get_template('download.html').render(app=self)
+				content = self.render_template('download.html', app=self)
 			elif request.prepath[0:1] == ['sources']:
 				for source in self.sources:
-					content += self.jinja.get_template('source.html').render(app=self, source=self.sources[source])
+					content += self.render_template('source.html', app=self, source=self.sources[source])
 			elif request.prepath == ['active']:
-				return self.jinja.get_template('file_list.html').render(app=self, source=self.active).encode('utf-8')
+				return self.respond(request, self.render_template('file_list.html', app=self, source=self.active).encode('utf-8'))
 			else:
-				content = self.jinja.get_template('active.html').render(app=self, source=self.active)
+				content = self.render_template('active.html', app=self, source=self.active)
 		except RequestRedirection as e:
 			url = e.args[0]
 			return redirectTo(url.encode('ascii'), request)
 		#child = self.getChildForLeafRequest(request)
 		#print(repr(child))
 		#return html+child.render(request)
-		m = self.jinja.get_template('index.html')
-		return m.render(app=self, content=content).encode('utf-8')
+		return self.respond(request, self.render_template('index.html', app=self, content=content).encode('utf-8'))
+
+	def render_api(self, request, path):
+		"""JSON API, GET api/files lists the queue and POST api/<action>
+		takes a JSON body, see api_enqueue and DownloadQueue.control."""
+		request.setHeader('Content-Type', 'application/json')
+		actions = ['pause', 'resume', 'cancel', 'retry', 'priority']
+		# cross-origin pages can only POST form or text bodies without a preflight
+		if request.method == 'POST' and (request.getHeader('content-type') or '').split(';')[0].strip() != 'application/json':
+			request.setResponseCode(http.UNSUPPORTED_MEDIA_TYPE)
+			return json.dumps({'error' : 'expected an application/json body'})
+		try:
+			if path == ['files']:
+				cursor = int(request.args.get('cursor', [-1])[0])
+				limit = int(request.args.get('limit', [100])[0])
+				state = request.args.get('state', [None])[0]
+				return self.respond(request, json.dumps(self.queue.list(cursor, limit, state)))
+			elif path == ['enqueue'] and request.method == 'POST':
+				result = self.api_enqueue(self.api_body(request))
+			elif len(path) == 1 and path[0] in actions and request.method == 'POST':
+				body = self.api_body(request)
+				result = self.queue.control(path[0], body['files'], body.get('priority'))
+			else:
+				request.setResponseCode(http.NOT_FOUND)
+				return json.dumps({'error' : 'unknown api call %s' % ('/'.join(path),)})
+		except (ValueError, KeyError, IndexError, TypeError, re.error) as e:
+			request.setResponseCode(http.BAD_REQUEST)
+			return json.dumps({'error' : str(e)})
+		return json.dumps(result)
+
+	def api_body(self, request):
+		body = json.loads(request.content.read())
+		if not isinstance(body, dict):
+			raise ValueError('request body must be a JSON object')
+		return body
+
+	def api_enqueue(self, body):
+		"""Queue entries of a source, either by index ("ids") or by a
+		regex on their names ("match"), and/or raw "module:url" strings
+		("urls")."""
+		files = []
+		if 'source' in body:
+			source = self.sources[body['source']]
+			if 'match' in body:
+				ids = source.search(re.compile(body['match'], re.UNICODE))
+			else:
+				ids = [int(i) for i in body['ids']]
+			files += [source.file(i) for i in ids]
+		for url in body.get('urls', []):
+			url = url.encode('ascii')
+			module, path = url.split(':', 1)
+			if module not in self.enabled:
+				raise KeyError('Module %s is not enabled' % (module,))
+			name = safe_name(urlparse.urlparse(path).path)
+			files.append(DownloaderFile(self, url, self.target, name = name))
+		entries = [self.queue.enqueue(f, int(body.get('priority', 0)), bool(body.get('paused', False))) for f in files]
+		self.queue.schedule()
+		return {'files' : [self.queue.describe(entry) for entry in entries]}
+
+	gzip_min_size = 1024
+
+	def respond(self, request, body):
+		"""Answer with 304 when the client already has this exact body,
+		gzip it otherwise if the client accepts it and it is large enough."""
+		etag = hashlib.md5(body).hexdigest()
+		accept = request.getHeader('accept-encoding') or ''
+		gzip = len(body) >= self.gzip_min_size and 'gzip' in accept
+		if gzip:
+			etag += '-gzip'
+		request.setHeader('Cache-Control', 'no-cache')
+		request.setHeader('Vary', 'Accept-Encoding')
+		if request.setETag('"%s"' % (etag,)) == http.CACHED:
+			return ''
+		if gzip:
+			compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			body = compressor.compress(body) + compressor.flush()
+			request.setHeader('Content-Encoding', 'gzip')
+		return body
+
+import unittest
+
+class DownloaderTestCase(unittest.TestCase):
+	"""Runs a Downloader whose FakeDownloader downloads wait for
+	finish() or fail(), timers run on a task.Clock."""
+
+	config = {}
+
+	def setUp(self):
+		if 'FakeDownloader' not in Downloader.modules:
+			Downloader.register('FakeDownloader', 'modules.fake')
+		self._target = tempfile.mkdtemp()
+		config = {
+			'target' : self._target,
+			'retries' : 0,
+			'modules' : {'FakeDownloader' : {'hold' : True}},
+		}
+		config.update(self.config)
+		self.manager = Downloader(config)
+		self.clock = self.manager.clock = task.Clock()
+		self.fake = self.manager.enabled['FakeDownloader']
+
+	def tearDown(self):
+		shutil.rmtree(self._target)
+
+	def enqueue(self, *names, **options):
+		body = dict(options, urls = ['FakeDownloader:fake://host/%s' % (name,) for name in names])
+		return [self.manager.queue._entries[entry['id']] for entry in self.manager.api_enqueue(body)['files']]
+
+	def states(self, entries):
+		return [str(entry.file.state()) for entry in entries]
+
+class TestDownloadQueue(DownloaderTestCase):
+	config = {'concurrency' : 2}
+
+	def test_concurrency(self):
+		entries = self.enqueue('a', 'b', 'c')
+		self.assertEqual(self.states(entries), ['REQUESTED', 'REQUESTED', 'WAITING'])
+		self.assertEqual(self.manager.queue.running(), 2)
+		self.fake.finish(entries[0].file)
+		self.assertEqual(self.states(entries), ['FINISHED', 'REQUESTED', 'REQUESTED'])
+		self.assertEqual(self.manager.queue.running(), 2)
+
+	def test_priority(self):
+		entries = self.enqueue('a', 'b')
+		low = self.enqueue('c')[0]
+		high = self.enqueue('d', priority = 5)[0]
+		self.fake.finish(entries[0].file)
+		self.assertEqual(self.states([low, high]), ['WAITING', 'REQUESTED'])
+
+	def test_pause_resume(self):
+		entries = self.enqueue('a', 'b', 'c')
+		self.assertEqual(self.manager.queue.control('pause', [entries[2].id]), {'files' : [entries[2].id], 'skipped' : []})
+		self.assertEqual(self.manager.queue.control('pause', [entries[0].id]), {'files' : [], 'skipped' : [entries[0].id]})
+		self.fake.finish(entries[0].file)
+		self.assertEqual(str(entries[2].file.state()), 'WAITING')
+		self.manager.queue.control('resume', [entries[2].id])
+		self.assertEqual(str(entries[2].file.state()), 'REQUESTED')
+
+	def test_cancel(self):
+		entries = self.enqueue('a', 'b', 'c', 'd')
+		self.manager.queue.control('cancel', [entries[0].id, entries[3].id])
+		self.assertEqual(self.states(entries), ['ERROR', 'REQUESTED', 'REQUESTED', 'ERROR'])
+		self.assertEqual(self.fake.requests, 3)
+
+	def test_retry(self):
+		entry = self.enqueue('a')[0]
+		self.fake.fail(entry.file, ValueError('boom'))
+		self.assertEqual(str(entry.file.state()), 'ERROR')
+		self.manager.queue.control('retry', [entry.id])
+		self.assertEqual(str(entry.file.state()), 'REQUESTED')
+		self.assertEqual(self.fake.requests, 2)
+
+	def test_raising_module(self):
+		def download(f):
+			raise ValueError('boom')
+		self.fake.download = download
+		# more than the queue keeps, read the states from the response
+		body = {'urls' : ['FakeDownloader:fake://host/%d' % (i,) for i in range(0, 2000)]}
+		files = self.manager.api_enqueue(body)['files']
+		self.assertEqual(set(f['state'] for f in files), set(['ERROR']))
+		self.assertEqual(self.manager.queue.running(), 0)
+
+	def test_missing_module(self):
+		entry = self.manager.queue.enqueue(DownloaderFile(self.manager, 'MissingDownloader:fake://host/a', self._target, name = 'a'))
+		entries = [entry] + self.enqueue('b', 'c')
+		self.assertEqual(self.states(entries), ['ERROR', 'REQUESTED', 'REQUESTED'])
+		self.assertEqual(self.manager.queue.running(), 2)
+
+	def test_cursor(self):
+		entries = self.enqueue('a', 'b', 'c', 'd', 'e')
+		pages, cursor = [], -1
+		while cursor is not None:
+			page = self.manager.queue.list(cursor, limit = 2)
+			pages.append([f['id'] for f in page['files']])
+			cursor = page['cursor']
+		ids = [entry.id for entry in entries]
+		self.assertEqual(pages, [ids[0:2], ids[2:4], ids[4:]])
+		self.assertEqual([f['id'] for f in self.manager.queue.list(state = 'WAITING')['files']], ids[2:])
+
+	def test_api(self):
+		from twisted.web.test.requesthelper import DummyRequest
+		from StringIO import StringIO
+		def post(body, content_type = 'application/json'):
+			request = DummyRequest(['api', 'enqueue'])
+			request.method = 'POST'
+			request.requestHeaders.setRawHeaders('content-type', [content_type])
+			request.content = StringIO(body)
+			self.manager.render_api(request, ['enqueue'])
+			return request.responseCode
+		self.assertEqual(post('"x"'), http.BAD_REQUEST)
+		self.assertEqual(post('[1]'), http.BAD_REQUEST)
+		self.assertEqual(post('{"urls" : ["FakeDownloader:fake://host/a/%2E%2E"]}'), http.BAD_REQUEST)
+		self.assertEqual(post('{"urls" : ["FakeDownloader:fake://host/a"]}', 'text/plain'), http.UNSUPPORTED_MEDIA_TYPE)
+		self.assertEqual(self.fake.requests, 0)
+		self.assertEqual(post('{"urls" : ["FakeDownloader:fake://host/%2E%2E%2F.bashrc"]}', 'application/json; charset=utf-8'), None)
+		self.assertEqual(self.fake.held[0]._name, '.bashrc')
+		entry = self.enqueue('c', target = '/etc')[0]
+		self.assertEqual(entry.file._target, self._target)
+
+class TestFailover(DownloaderTestCase):
+	config = {'retries' : 3, 'retry_delay' : 10, 'retry_max_delay' : 25}
+
+	def download(self, *mirrors):
+		f = DownloaderFile(self.manager, 'FakeDownloader:fake://a/x', self._target, name = 'x', mirrors = mirrors)
+		f.download()
+		return f
+
+	def test_rank(self):
+		peers = PeerStats()
+		peers.record('FakeDownloader:fake://slow/x', 100, 10.0, True)
+		peers.record('FakeDownloader:fake://fast/x', 1000, 10.0, True)
+		peers.record('FakeDownloader:fake://flaky/x', 1000, 10.0, True)
+		peers.record('FakeDownloader:fake://flaky/y', 0, 10.0, False)
+		urls = ['FakeDownloader:fake://%s/x' % (peer,) for peer in ('slow', 'new', 'flaky', 'fast')]
+		self.assertEqual(peers.rank(urls), [urls[3], urls[1], urls[2], urls[0]])
+
+	def test_backoff(self):
+		f = self.download()
+		delays = []
+		for i in range(0, 3):
+			self.fake.fail(f, ValueError('boom'))
+			delays.append(f._retry.getTime() - self.clock.seconds())
+			f._retry.cancel()
+			f.start()
+		self.assertEqual(delays, [10, 20, 25])
+		self.fake.fail(f, ValueError('boom'))
+		self.assertEqual(str(f.state()), 'ERROR')
+		self.assertEqual(f._attempts, 3)
+
+	def test_mirror(self):
+		f = self.download('FakeDownloader:fake://b/x')
+		self.fake.fail(f, ValueError('boom'))
+		self.assertEqual(f.url(), 'fake://b/x')
+		f._retry.cancel()
+
+	def test_cancel(self):
+		f = self.download()
+		f.cancel()
+		self.assertEqual(str(f.state()), 'ERROR')
+		self.assertEqual(f._attempts, 0)
+		f = self.download()
+		self.fake.fail(f, ValueError('boom'))
+		f.cancel()
+		self.assertEqual(str(f.state()), 'ERROR')
+		self.assertEqual(f._retry, None)
+
+	def test_raising_trigger(self):
+		class Trigger(object):
+			def on_finished(self, f):
+				raise OSError('move failed')
+		self.manager.triggers['enabled']['raising'] = Trigger()
+		self.addCleanup(self.manager.triggers['enabled'].pop, 'raising')
+		f = DownloaderFile(self.manager, 'FakeDownloader:fake://a/x', self._target, name = 'x', triggers = {'on_finished' : ['raising']})
+		f.download()
+		self.fake.finish(f)
+		f._deferred.addErrback(lambda failure: failure.trap(OSError))
+		self.assertEqual(str(f.state()), 'FINISHED')
+		self.assertEqual(f._attempts, 0)
+		self.assertEqual(f._retry, None)
+		self.assertEqual(self.manager.peers._peers['a'][2:], [1, 0])
+
+class TestTimeouts(DownloaderTestCase):
+	config = {'modules' : {'FakeDownloader' : {'hold' : True, 'timeouts' : {'progress' : 5}}}}
+
+	def download(self, url = 'FakeDownloader:fake://host/x'):
+		errors = []
+		f = DownloaderFile(self.manager, url, self._target, name = 'x')
+		f.download(None, errors.append)
+		return f, errors
+
+	def test_progress(self):
+		f, errors = self.download()
+		# not watched until the transfer starts
+		self.clock.advance(5)
+		f.open()
+		f.write('x')
+		self.clock.advance(5)
+		self.assertEqual(str(f.state()), 'DOWNLOADING')
+		self.clock.advance(5)
+		self.assertEqual(str(f.state()), 'ERROR')
+		self.assertTrue(errors[0].check(defer.TimeoutError))
+		self.assertEqual(self.clock.getDelayedCalls(), [])
+
+	def test_offer(self):
+		from modules.irc import XDccFileReceiveFactory
+		f, errors = self.download()
+		sessions = []
+		sessions.append(XDccFileReceiveFactory(f, 'bot', sessions, {'offer' : 30}, self.clock))
+		self.clock.advance(30)
+		self.assertEqual(sessions, [])
+		self.assertEqual(str(f.state()), 'ERROR')
+		self.assertTrue(errors[0].check(defer.TimeoutError))
+
+	def test_connect(self):
+		from modules.irc import XDccFileReceiveFactory, DccState
+		from twisted.internet import error
+		f, errors = self.download()
+		sessions = []
+		dcc = XDccFileReceiveFactory(f, 'bot', sessions, {'offer' : 30}, self.clock)
+		sessions.append(dcc)
+		dcc.clientConnectionFailed(None, failure.Failure(error.ConnectionRefusedError()))
+		self.assertEqual(dcc.state, DccState.ERROR)
+		self.assertEqual(sessions, [])
+		self.assertTrue(errors[0].check(error.ConnectionRefusedError))
+		self.assertEqual(self.clock.getDelayedCalls(), [])
+
+	def test_response(self):
+		if 'HttpDownloader' not in Downloader.modules:
+			Downloader.register('HttpDownloader', 'modules.http')
+		self.manager.enable('HttpDownloader', {'timeouts' : {'response' : 10, 'progress' : 0}})
+		# the reactor never runs, the connection attempt stays pending
+		f, errors = self.download('HttpDownloader:http://127.0.0.1:9/x')
+		self.clock.advance(10)
+		self.assertEqual(str(f.state()), 'ERROR')
+		self.assertTrue(errors[0].check(defer.TimeoutError))
+		self.assertEqual(self.manager.enabled['HttpDownloader'].connectors, {})
+
+class TestListing(DownloaderTestCase):
+	config = {'listing_ttl' : 30}
+	url = 'FakeDownloader:fake://host/list'
+	body = 'a 1\nb 2\n'
+
+	def fetch(self, listing, force = False):
+		results = []
+		listing.fetch(force).addBoth(results.append)
+		return results
+
+	def test_single_flight(self):
+		listing = self.manager.listing(self.url)
+		self.assertIs(self.manager.listing(self.url), listing)
+		first, second = self.fetch(listing), self.fetch(listing)
+		self.assertEqual(self.fake.requests, 1)
+		self.fake.finish(self.fake.held[0], self.body)
+		self.assertEqual(first + second, [listing, listing])
+		pattern = re.compile(r'(\w) (\d)')
+		self.assertEqual(listing.findall(pattern), [('a', '1'), ('b', '2')])
+		self.assertIs(listing.findall(pattern), listing.findall(re.compile(r'(\w) (\d)')))
+
+	def test_ttl(self):
+		listing = self.manager.listing(self.url)
+		self.fetch(listing)
+		self.fake.finish(self.fake.held[0], self.body)
+		self.assertEqual(self.fetch(listing), [listing])
+		self.assertEqual(self.fake.requests, 1)
+		listing._fetched -= 30
+		self.fetch(listing)
+		self.assertEqual(self.fake.requests, 2)
+
+	def test_error_not_cached(self):
+		listing = self.manager.listing(self.url)
+		self.fetch(listing)
+		self.fake.finish(self.fake.held[0], self.body)
+		listing._fetched -= 30
+		results = self.fetch(listing)
+		self.fake.fail(self.fake.held[0], ValueError('boom'))
+		self.assertTrue(results[0].check(ValueError))
+		self.fetch(listing)
+		self.assertEqual(self.fake.requests, 3)
+
+	def test_sources(self):
+		config = {'source' : self.url, 'target' : self._target, 'pattern' : r'(\w) (\d)', 'url' : 'FakeDownloader:fake://host/{0}', 'filename' : '{0}', 'filesize' : '{1}'}
+		sources = [DownloaderSource(self.manager, name, config) for name in ('a', 'b')]
+		self.assertEqual(self.fake.requests, 1)
+		self.fake.finish(self.fake.held[0], self.body)
+		self.assertEqual([source.count() for source in sources], [2, 2])
+		# rows not materialized yet look like waiting files
+		state = sources[0].entry(0).state()
+		self.assertEqual((str(state), state.equal('WAITING'), state.active(), state.done()), ('WAITING', True, False, False))
+		self.assertRaises(TypeError, state.set, 'REQUESTED')
+		sources[0].file(0)
+		self.assertIsInstance(sources[0].entry(0), DownloaderFile)
+		sources[0].refresh()
+		self.assertEqual(self.fake.requests, 1)
+		# the refresh button skips the cache
+		self.assertRaises(RequestRedirection, sources[0].render, ['refresh'])
+		self.assertEqual(self.fake.requests, 2)
 
 if __name__ == '__main__':
 	# initialize logging
@@ -0,0 +1,453 @@
+# twisted imports
+from twisted.internet import reactor, protocol, defer, task, stdio
+from twisted.protocols.basic import LineReceiver
+from twisted.python import reflect
+
+# system imports
+import sys
+import os
+import json
+import urlparse
+
+class WorkerProtocol(protocol.ProcessProtocol):
+	"""Parent side of the channel to a worker process.
+
+	Commands are written as JSON lines to the child's stdin and events are
+	read as JSON lines from its file descriptor 3, so modules can keep
+	printing on stdout.
+	"""
+
+	def __init__(self, worker):
+		self.worker = worker
+		self.buffer = ''
+		# False once the child's stdin is closed
+		self.alive = True
+
+	def childDataReceived(self, childFD, data):
+		if childFD != 3:
+			sys.stdout.write(data)
+			return
+		self.buffer += data
+		while '\n' in self.buffer:
+			line, self.buffer = self.buffer.split('\n', 1)
+			if line:
+				self.worker.received(json.loads(line))
+
+	def send(self, message):
+		"""Returns False when the child can no longer be written to."""
+		if not self.alive:
+			return False
+		self.transport.writeToChild(0, json.dumps(message) + '\n')
+		return True
+
+	def childConnectionLost(self, childFD):
+		if childFD == 0:
+			self.alive = False
+
+	def processEnded(self, reason):
+		self.alive = False
+		self.worker.ended(reason)
+
+class Worker(object):
+	"""A worker process running one instance of a module.
+
+	The DownloaderFile objects stay in the web process, the worker mirrors
+	their state and progress back to them.
+	"""
+
+	respawn = 5.0
+	clock = reactor
+
+	def __init__(self, name, keys, config):
+		self.name = name
+		self.keys = keys
+		self.config = config
+		self.protocol = None
+		self.pid = None
+		self.schemes = []
+		self.files = {}
+		self.spawn()
+
+	def spawn(self):
+		script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workers.py')
+		args = [sys.executable, script, self.name, json.dumps(self.config)]
+		self.protocol = WorkerProtocol(self)
+		transport = reactor.spawnProcess(self.protocol, sys.executable, args, env = os.environ, path = os.getcwd(), childFDs = {0 : 'w', 1 : 'r', 2 : 'r', 3 : 'r'})
+		self.pid = transport.pid
+
+	def running(self):
+		return self.protocol is not None and self.protocol.alive
+
+	def load(self):
+		return len(self.files)
+
+	def download(self, f):
+		f._deferred = defer.Deferred()
+		sent = self.running() and self.protocol.send({
+			'cmd' : 'download',
+			'id' : id(f),
+			'url' : '%s:%s' % (f._module, f._url),
+			'target' : f._target,
+			'name' : f._name,
+			'size' : f._size,
+			'received' : f._received,
+			'temp' : f._temp,
+		})
+		if sent:
+			self.files[id(f)] = f
+		else:
+			f._deferred.errback(ValueError('worker %s %s is not running' % (self.name, self.keys)))
+		return f._deferred
+
+	def cancel(self, f):
+		if id(f) not in self.files:
+			return False
+		return self.protocol.send({'cmd' : 'cancel', 'id' : id(f)})
+
+	@staticmethod
+	def error(message):
+		"""Rebuild the exception a worker reported, ValueError if its type
+		cannot be imported here."""
+		try:
+			error = reflect.namedAny(message.get('type', ''))
+			if isinstance(error, type) and issubclass(error, Exception):
+				return error(message['reason'])
+		except Exception:
+			pass
+		return ValueError(message['reason'])
+
+	def received(self, message):
+		if message['event'] == 'hello':
+			self.schemes = message['schemes']
+			return
+		f = self.files.get(message['id'])
+		if f is None:
+			return
+		if message['event'] == 'update':
+			f._name = message['name']
+			f._filename = message['filename']
+			f._size = message['size']
+			f._received = message['received']
+			f._path = message['path']
+			if message['state'] == 'DOWNLOADING' and not f.state().equal('DOWNLOADING'):
+				if not f._temp:
+					f._manager.active.add(f)
+				f.state().set('DOWNLOADING')
+		elif message['event'] == 'success':
+			del self.files[message['id']]
+			f._deferred.callback(None)
+		elif message['event'] == 'error':
+			del self.files[message['id']]
+			f._deferred.errback(self.error(message))
+
+	def ended(self, reason):
+		print('Worker %s %s exited: %s' % (self.name, self.keys, reason.getErrorMessage()))
+		self.protocol = None
+		files, self.files = self.files, {}
+		for f in files.values():
+			f._deferred.errback(ValueError('worker process exited'))
+		self.clock.callLater(self.respawn, self.spawn)
+
+class WorkerPool(object):
+	"""Run a module in worker processes instead of the web process.
+
+	Enabled by setting "worker" in the module config. Modules providing a
+	partition() static method (see XdccDownloader) get one process per part
+	and downloads are routed on the url host; other modules get "worker"
+	identical processes and downloads go to the least loaded one. Workers
+	waiting to be respawned are skipped.
+	"""
+
+	worker = Worker
+
+	def __init__(self, manager, name, module, config):
+		self.manager = manager
+		self.name = name
+		config = dict(config)
+		count = int(config.pop('worker'))
+		# the module defaults, progress is watched in this process too
+		self.timeouts = dict(getattr(module, 'timeouts', {}))
+		self.timeouts.update(config.get('timeouts', {}))
+		self.workers = []
+		if hasattr(module, 'partition'):
+			for keys, part in module.partition(config):
+				self.workers.append(self.worker(name, keys, part))
+		else:
+			for i in range(0, max(1, count)):
+				self.workers.append(self.worker(name, [], config))
+
+	def schemes(self):
+		schemes = []
+		for worker in self.workers:
+			for scheme in worker.schemes:
+				if scheme not in schemes:
+					schemes.append(scheme)
+		return schemes
+
+	def select(self, f):
+		netloc = urlparse.urlparse(f.url()).netloc
+		running = [worker for worker in self.workers if worker.running()]
+		workers = [worker for worker in running if netloc in worker.keys]
+		if not workers:
+			workers = [worker for worker in running if not worker.keys]
+		if not workers:
+			return None
+		return min(workers, key = lambda worker: worker.load())
+
+	def download(self, f):
+		worker = self.select(f)
+		if worker is None:
+			f._deferred = defer.Deferred()
+			f._deferred.errback(ValueError("no worker found for %s" % (f.url(),)))
+			return f._deferred
+		return worker.download(f)
+
+	def cancel(self, f):
+		for worker in self.workers:
+			if worker.cancel(f):
+				return True
+		return False
+
+	def render(self, path):
+		html = '<h1>Workers</h1>\n'
+		for worker in self.workers:
+			html += '<h2>' + (', '.join(worker.keys) or self.name) + '</h2>\n'
+			html += '<p>pid %s, %d active downloads</p>\n' % (worker.pid, worker.load())
+		return html
+
+class WorkerManager(object):
+	"""Stand-in for Downloader inside a worker process.
+
+	Triggers are not enabled here, they run in the web process once the
+	final state has been reported. Retries are left to the web process too.
+	"""
+
+	retries = 0
+	clock = reactor
+
+	def __init__(self, web, name, config):
+		self.triggers = {"available":{}, "enabled":{}}
+		self.active = web.ActiveSource()
+		self.peers = web.PeerStats()
+		self.enabled = {name : web.Downloader.module(name)(self, config)}
+
+class WorkerChannel(LineReceiver):
+	"""Child side of the channel, see WorkerProtocol."""
+
+	delimiter = '\n'
+	interval = 1.0
+
+	def __init__(self, web, manager, name):
+		self.web = web
+		self.manager = manager
+		self.name = name
+		self.files = {}
+		self.reported = {}
+		self._task = None
+
+	def send(self, message):
+		self.sendLine(json.dumps(message))
+
+	def connectionMade(self):
+		self.send({'event' : 'hello', 'schemes' : self.manager.enabled[self.name].schemes()})
+		self._task = task.LoopingCall(self.report_all)
+		self._task.clock = self.manager.clock
+		self._task.start(self.interval, now = False)
+
+	def connectionLost(self, reason):
+		reactor.stop()
+
+	def lineReceived(self, line):
+		message = json.loads(line)
+		if message['cmd'] == 'download':
+			self.download(message)
+		elif message['cmd'] == 'cancel' and message['id'] in self.files:
+			self.files[message['id']].cancel()
+
+	def download(self, message):
+		id = message['id']
+		f = self.web.DownloaderFile(self.manager, message['url'], message['target'], name = message['name'], temp = message['temp'])
+		f._size = message['size']
+		f._received = message['received']
+		self.files[id] = f
+		f.download(lambda d: self.done(id, None), lambda d: self.done(id, d))
+
+	def report(self, id):
+		f = self.files[id]
+		update = {
+			'event' : 'update',
+			'id' : id,
+			'state' : str(f.state()),
+			'name' : f._name,
+			'filename' : f._filename,
+			'size' : f._size,
+			'received' : f._received,
+			'path' : f.path(),
+		}
+		if self.reported.get(id) != update:
+			self.reported[id] = update
+			self.send(update)
+
+	def report_all(self):
+		for id in self.files.keys():
+			self.report(id)
+
+	def done(self, id, failure):
+		self.report(id)
+		if failure is None:
+			self.send({'event' : 'success', 'id' : id})
+		else:
+			self.send({'event' : 'error', 'id' : id, 'type' : reflect.qual(failure.type), 'reason' : failure.getErrorMessage()})
+		del self.files[id]
+		del self.reported[id]
+
+def main(name, config):
+	import web
+	web.Downloader.loadModules()
+	manager = WorkerManager(web, name, json.loads(config))
+	stdio.StandardIO(WorkerChannel(web, manager, name), stdin = 0, stdout = 3)
+	reactor.run()
+
+import unittest
+import tempfile
+import shutil
+
+from twisted.test.proto_helpers import StringTransport
+from twisted.python import failure
+
+class FakeProcess(StringTransport):
+	"""Parent side transport, writes to the child's stdin are recorded."""
+
+	def writeToChild(self, childFD, data):
+		self.write(data)
+
+class FakeWorker(Worker):
+	clock = None
+
+	def spawn(self):
+		self.clock = task.Clock()
+		self.protocol = WorkerProtocol(self)
+		self.protocol.makeConnection(FakeProcess())
+		self.pid = 0
+
+	def sent(self):
+		return [json.loads(line) for line in self.protocol.transport.value().splitlines()]
+
+	def event(self, message):
+		self.protocol.childDataReceived(3, json.dumps(message) + '\n')
+
+class WorkerTestCase(unittest.TestCase):
+	def setUp(self):
+		import web
+		if 'FakeDownloader' not in web.Downloader.modules:
+			web.Downloader.register('FakeDownloader', 'modules.fake')
+		self.web = web
+		self._target = tempfile.mkdtemp()
+		self.manager = WorkerManager(web, 'FakeDownloader', {'hold' : True})
+		self.manager.clock = task.Clock()
+
+	def tearDown(self):
+		shutil.rmtree(self._target)
+
+	def file(self, name = 'x'):
+		return self.web.DownloaderFile(self.manager, 'FakeDownloader:fake://host/%s' % (name,), self._target, name = name)
+
+class TestWorkerChannel(WorkerTestCase):
+	def setUp(self):
+		WorkerTestCase.setUp(self)
+		self.transport = StringTransport()
+		self.channel = WorkerChannel(self.web, self.manager, 'FakeDownloader')
+		self.channel.makeConnection(self.transport)
+		self.fake = self.manager.enabled['FakeDownloader']
+
+	def sent(self):
+		lines = [json.loads(line) for line in self.transport.value().splitlines()]
+		self.transport.clear()
+		return lines
+
+	def download(self, id):
+		self.channel.dataReceived(json.dumps({'cmd' : 'download', 'id' : id, 'url' : 'FakeDownloader:fake://host/x', 'target' : self._target, 'name' : 'x', 'size' : None, 'received' : 0, 'temp' : False}) + '\n')
+		return self.fake.held[-1]
+
+	def test_success(self):
+		self.assertEqual(self.sent(), [{'event' : 'hello', 'schemes' : []}])
+		f = self.download(1)
+		self.fake.finish(f, 'data')
+		update, success = self.sent()
+		self.assertEqual((update['event'], update['state'], update['received']), ('update', 'FINISHED', 4))
+		self.assertEqual(success, {'event' : 'success', 'id' : 1})
+		self.assertEqual(self.channel.files, {})
+
+	def test_error(self):
+		self.sent()
+		self.fake.fail(self.download(1), defer.TimeoutError('no offer'))
+		self.assertEqual(self.sent()[-1]['type'], 'twisted.internet.defer.TimeoutError')
+		self.download(2)
+		self.channel.dataReceived(json.dumps({'cmd' : 'cancel', 'id' : 2}) + '\n')
+		self.assertEqual(self.sent()[-1]['type'], 'twisted.internet.defer.CancelledError')
+
+	def test_report(self):
+		self.sent()
+		f = self.download(1)
+		f.open()
+		self.manager.clock.advance(self.channel.interval)
+		self.assertEqual(self.sent()[0]['state'], 'DOWNLOADING')
+		# unchanged files are not reported again
+		self.manager.clock.advance(self.channel.interval)
+		self.assertEqual(self.sent(), [])
+
+class TestWorker(WorkerTestCase):
+	def setUp(self):
+		WorkerTestCase.setUp(self)
+		self.worker = FakeWorker('FakeDownloader', [], {})
+
+	def test_download(self):
+		self.worker.event({'event' : 'hello', 'schemes' : ['fake']})
+		self.assertEqual(self.worker.schemes, ['fake'])
+		f = self.file()
+		results = []
+		self.worker.download(f).addBoth(results.append)
+		command = self.worker.sent()[0]
+		self.assertEqual((command['cmd'], command['id'], command['url']), ('download', id(f), 'FakeDownloader:fake://host/x'))
+		self.worker.event({'event' : 'update', 'id' : id(f), 'state' : 'DOWNLOADING', 'name' : 'x', 'filename' : 'x', 'size' : 10, 'received' : 5, 'path' : None})
+		self.assertEqual((str(f.state()), f.progress()), ('DOWNLOADING', 50))
+		self.worker.event({'event' : 'success', 'id' : id(f)})
+		self.assertEqual(results, [None])
+		self.assertEqual(self.worker.load(), 0)
+
+	def test_error_type(self):
+		f = self.file()
+		results = []
+		self.worker.download(f).addErrback(results.append)
+		self.worker.event({'event' : 'error', 'id' : id(f), 'type' : 'twisted.internet.defer.TimeoutError', 'reason' : 'no offer'})
+		self.assertTrue(results[0].check(defer.TimeoutError))
+		self.assertEqual(Worker.error({'type' : 'no.such.Error', 'reason' : 'x'}).__class__, ValueError)
+
+	def test_ended(self):
+		f = self.file()
+		results = []
+		self.worker.download(f).addErrback(results.append)
+		self.worker.protocol.childConnectionLost(0)
+		self.worker.protocol.processEnded(failure.Failure(ValueError('killed')))
+		self.assertEqual(len(results), 1)
+		# while waiting for the respawn, nothing is registered
+		g = self.file('y')
+		self.worker.download(g).addErrback(results.append)
+		self.assertEqual(len(results), 2)
+		self.assertEqual(self.worker.load(), 0)
+		self.worker.clock.advance(self.worker.respawn)
+		self.assertTrue(self.worker.running())
+
+	def test_select(self):
+		class Pool(WorkerPool):
+			worker = FakeWorker
+		pool = Pool(self.manager, 'FakeDownloader', object, {'worker' : 2})
+		f = self.file()
+		pool.workers[0].protocol.childConnectionLost(0)
+		self.assertIs(pool.select(f), pool.workers[1])
+		pool.workers[1].protocol.childConnectionLost(0)
+		self.assertIs(pool.select(f), None)
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:3])